@@ -17,10 +17,23 @@ import dbus.mainloop.glib
 import gobject as GObject
 
 import daemon
-from .wpantun import Wpantun
+from .wpantun import Wpantun, DEFAULT_INTERFACE
+from .wpantun import COALESCE_WINDOW, REQUEST_TIMEOUT
 from .ble import Ble
+from .timing import PhaseTimer
+from .snapshot import SnapshotStore
+from .snapshot import DEFAULT_PATH as SNAPSHOT_PATH
+from .scheduler import AdvertisingScheduler, ASSOCIATED_POLICIES
+from . import log
+from . import metrics
+from .metrics import StatsObject
+from .profiling import Profiler
 
 mainloop = None
+profiler = None
+
+# Seconds between exports of the metrics file
+METRICS_INTERVAL = 10
 
 logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
                     stream=sys.stderr, level=logging.INFO)
@@ -31,26 +44,32 @@ def quit_cb(signal_number, stack_frame):
     mainloop.quit()
 
 
-def register_ad_reply_cb():
-    logging.info('Advertisement registered')
+def flush_log_cb(signal_number, stack_frame):
+    log.flush()
 
 
-def register_ad_error_cb(error):
-    logging.info('Failed to register advertisement: ' + str(error))
-    mainloop.quit()
+def toggle_profile_cb(signal_number, stack_frame):
+    profiler.toggle()
 
 
-def register_gatt_reply_cb():
-    logging.info('GATT application registered')
+def dump_profile_cb(signal_number, stack_frame):
+    try:
+        profiler.dump()
+    except (IOError, OSError) as err:
+        logging.error('Failed to write profile: ' + str(err))
 
 
-def register_gatt_error_cb(error):
-    logging.info('Failed to register application: ' + str(error))
-    mainloop.quit()
+def write_metrics_cb(path):
+    try:
+        metrics.registry.write_prometheus(path)
+    except (IOError, OSError) as err:
+        logging.error('Failed to write metrics: ' + str(err))
+    return True
 
 
 def main():
     global mainloop
+    global profiler
 
     parser = argparse.ArgumentParser(description="KNoT NetSetup Daemon")
     parser.add_argument("-w", "--working-dir", metavar="<path>",
@@ -63,44 +82,116 @@ def main():
     parser.add_argument("-a", "--ad-name", metavar="<ad-name>",
                         default="KNoTAdvertisement", type=str,
                         help="Advertisement name")
+    parser.add_argument("-i", "--interface", metavar="<wpanX>",
+                        action="append", dest="interfaces",
+                        help="wpantund interface to expose, may be repeated."
+                        " Defaults to wpan0")
+    parser.add_argument("-s", "--ad-status", action="store_true",
+                        help="Advertise the network status as manufacturer"
+                        " data")
+    parser.add_argument("--ad-associated", metavar="<policy>",
+                        choices=ASSOCIATED_POLICIES,
+                        help="Advertise fast until every NCP is associated,"
+                        " then follow this policy: fast, slow or off")
+    parser.add_argument("--ad-fast-interval", metavar="<ms>",
+                        default=100, type=int,
+                        help="Fast advertising interval")
+    parser.add_argument("--ad-slow-interval", metavar="<ms>",
+                        default=1000, type=int,
+                        help="Slow advertising interval")
+    parser.add_argument("--ad-slow-tx-power", metavar="<dBm>",
+                        type=int,
+                        help="TX power while advertising slowly")
+    parser.add_argument("-c", "--coalesce-window", metavar="<ms>",
+                        default=COALESCE_WINDOW, type=int,
+                        help="Merge wpantund property changes arriving"
+                        " within this window, 0 to apply each at once")
+    parser.add_argument("--wpantund-timeout", metavar="<seconds>",
+                        default=REQUEST_TIMEOUT, type=float,
+                        help="Time to wait for wpantund to answer")
+    parser.add_argument("-b", "--adapter", metavar="<hciX>",
+                        action="append", dest="adapters",
+                        help="Bluetooth adapter to serve on, may be repeated."
+                        " Defaults to the first adapter found")
+    parser.add_argument("--all-adapters", action="store_true",
+                        help="Serve on every Bluetooth adapter")
+    parser.add_argument("-t", "--state-file", metavar="<path>",
+                        default=SNAPSHOT_PATH, type=str,
+                        help="Snapshot of the last known network parameters")
+    parser.add_argument("-m", "--metrics-file", metavar="<path>",
+                        type=str,
+                        help="Export the metrics to this Prometheus text file")
+    parser.add_argument("-l", "--log-level", metavar="<level>",
+                        default="INFO", type=str.upper,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging level")
+    parser.add_argument("--log-buffer", metavar="<records>",
+                        default=0, type=int,
+                        help="Keep the log in a ring buffer of this size,"
+                        " written out only on errors or SIGHUP")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile from startup. SIGUSR1 toggles"
+                        " profiling, SIGUSR2 writes a report to the"
+                        " working directory")
     parser.add_argument("-n", "--detach-process", action="store_false",
                         help="Detached process")
     args = parser.parse_args()
 
+    log.setup(getattr(logging, args.log_level), args.log_buffer)
+    profiler = Profiler()
+
     context = daemon.DaemonContext(
         working_directory=args.working_dir,
         umask=0o002,
         detach_process=args.detach_process,
         pidfile=lockfile.FileLock(args.pid_file),
-        signal_map={signal.SIGTERM: quit_cb, signal.SIGINT: quit_cb},
+        signal_map={signal.SIGTERM: quit_cb, signal.SIGINT: quit_cb,
+                    signal.SIGHUP: flush_log_cb,
+                    signal.SIGUSR1: toggle_profile_cb,
+                    signal.SIGUSR2: dump_profile_cb},
         stdout=sys.stdout,
         stderr=sys.stderr,
     )
 
     with context:
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-
-        wpan = Wpantun()
-        bluetooth = Ble(wpan, args.ad_name)
-
         mainloop = GObject.MainLoop()
-
-        bluetooth.ad_manager.RegisterAdvertisement(
-            bluetooth.ad_knot.get_path(), {},
-            reply_handler=register_ad_reply_cb,
-            error_handler=register_ad_error_cb)
-
-        bluetooth.gatt_manager.RegisterApplication(
-            bluetooth.gatt_knot.get_path(), {},
-            reply_handler=register_gatt_reply_cb,
-            error_handler=register_gatt_error_cb)
+        if args.profile:
+            profiler.start()
+
+        timer = PhaseTimer("Startup")
+        timer.start("bus setup")
+
+        wpans = [Wpantun(interface, coalesce_window=args.coalesce_window,
+                         request_timeout=args.wpantund_timeout)
+                 for interface in args.interfaces or [DEFAULT_INTERFACE]]
+        snapshots = SnapshotStore(args.state_file, wpans)
+        snapshots.load()
+
+        bluetooth = Ble(wpans, args.ad_name, args.adapters,
+                        args.all_adapters, args.ad_status)
+
+        # The scheduler is kept alive by the listeners it registers, and
+        # the stats object by the bus it is exported on
+        if args.ad_associated:
+            AdvertisingScheduler(bluetooth, wpans, args.ad_associated,
+                                 args.ad_fast_interval,
+                                 args.ad_slow_interval,
+                                 args.ad_slow_tx_power)
+
+        StatsObject(dbus.SystemBus())
+        if args.metrics_file:
+            GObject.timeout_add_seconds(METRICS_INTERVAL,
+                                        write_metrics_cb, args.metrics_file)
+
+        for wpan in wpans:
+            wpan.start(timer)
+        bluetooth.start(timer)
+        timer.stop("bus setup")
 
         mainloop.run()
 
-        bluetooth.gatt_manager.UnregisterApplication(bluetooth.gatt_knot)
-        bluetooth.ad_manager.UnregisterAdvertisement(bluetooth.ad_knot)
-        dbus.service.Object.remove_from_connection(bluetooth.gatt_knot)
-        dbus.service.Object.remove_from_connection(bluetooth.ad_knot)
+        bluetooth.unregister()
 
 
 if __name__ == "__main__":
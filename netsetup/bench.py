@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Benchmarks of the netsetup daemon against fake wpantund and BlueZ on a
+private bus. Run with: python -m netsetup.bench
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import dbus
+import dbus.mainloop.glib
+import gobject as GObject
+
+from . import ble
+from . import fakes
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+STATE_VALUES = ("offline", "associated")
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = int(round((len(ordered) - 1) * p / 100.0))
+    return ordered[index]
+
+
+def summarize(name, samples, elapsed=None):
+    """
+    Return a report line with the p50/p99/max of samples, in seconds, and
+    the throughput if the elapsed time is given
+    """
+    line = '%-28s n=%-6d p50=%8.3fms p99=%8.3fms max=%8.3fms' % (
+        name, len(samples), percentile(samples, 50) * 1000,
+        percentile(samples, 99) * 1000, max(samples or [0]) * 1000)
+    if elapsed:
+        line += ' %9.1f/s' % (len(samples) / elapsed)
+    return line
+
+
+def find_characteristics(bus, sender):
+    """
+    Return the characteristic paths exported by the daemon, by UUID
+    """
+    om = dbus.Interface(bus.get_object(sender, '/'), ble.DBUS_OM_IFACE)
+    paths = {}
+    for path, interfaces in om.GetManagedObjects().items():
+        chrc = interfaces.get(ble.GATT_CHRC_IFACE)
+        if chrc is not None and 'read' in chrc['Flags']:
+            paths.setdefault(str(chrc['UUID']), path)
+    return paths
+
+
+def bench_reads(bus, sender, paths, count):
+    results = []
+    for uuid, path in sorted(paths.items()):
+        chrc = dbus.Interface(bus.get_object(sender, path),
+                              ble.GATT_CHRC_IFACE)
+        samples = []
+        started = time.time()
+        for i in range(count):
+            t = time.time()
+            chrc.ReadValue({})
+            samples.append(time.time() - t)
+        results.append(summarize('ReadValue ' + uuid[-4:], samples,
+                                 time.time() - started))
+    return results
+
+
+def bench_managed_objects(bus, sender, count):
+    om = dbus.Interface(bus.get_object(sender, '/'), ble.DBUS_OM_IFACE)
+    samples = []
+    started = time.time()
+    for i in range(count):
+        t = time.time()
+        om.GetManagedObjects()
+        samples.append(time.time() - t)
+    return summarize('GetManagedObjects', samples, time.time() - started)
+
+
+def bench_managed_objects_scaling(max_services, count):
+    """
+    Time the GetManagedObjects handler in process, without the bus, for
+    1 to max_services services, with the cached response and rebuilding
+    it on every call
+    """
+    results = []
+    for services in range(1, max_services + 1):
+        # Not exported, the handler is called directly
+        app = ble.KnotApplication(None, [ble.ValueCache(None)
+                                         for i in range(services)])
+        for cached in (True, False):
+            samples = []
+            app.GetManagedObjects()
+            for i in range(count):
+                if not cached:
+                    app.invalidate()
+                t = time.time()
+                app.GetManagedObjects()
+                samples.append(time.time() - t)
+            results.append(summarize(
+                'GetManagedObjects %s N=%d' % (
+                    'cached' if cached else 'uncached', services),
+                samples))
+    return results
+
+
+def bench_propagation(bus, sender, path, count, timeout=5):
+    """
+    Measure the time from wpantund announcing a new NCP state to the
+    daemon notifying it on the state characteristic
+    """
+    chrc = dbus.Interface(bus.get_object(sender, path), ble.GATT_CHRC_IFACE)
+    chrc.StartNotify()
+
+    ncp = dbus.Interface(
+        bus.get_object(fakes.wpantun.INTERFACE_SERVICE_DBUS,
+                       fakes.wpantun.INTERFACE_DBUS_PATH + 'wpan0'),
+        fakes.FAKE_IFACE)
+
+    mainloop = GObject.MainLoop()
+    received = []
+
+    def properties_changed_cb(interface, changed, invalidated):
+        if 'Value' in changed:
+            received.append(time.time())
+            mainloop.quit()
+
+    def timeout_cb():
+        mainloop.quit()
+        return False
+
+    bus.add_signal_receiver(properties_changed_cb,
+                            signal_name='PropertiesChanged',
+                            dbus_interface=ble.DBUS_PROP_IFACE,
+                            bus_name=sender, path=path)
+
+    samples = []
+    for i in range(count):
+        del received[:]
+        sent = time.time()
+        ncp.SetProperty('NCP:State', STATE_VALUES[i % 2])
+        timer = GObject.timeout_add(timeout * 1000, timeout_cb)
+        mainloop.run()
+        GObject.source_remove(timer)
+        if received:
+            samples.append(received[0] - sent)
+
+    chrc.StopNotify()
+    return summarize('State change propagation', samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="KNoT NetSetup Daemon benchmarks")
+    parser.add_argument("--reads", type=int, default=1000,
+                        help="ReadValue calls per characteristic")
+    parser.add_argument("--calls", type=int, default=200,
+                        help="GetManagedObjects calls")
+    parser.add_argument("--changes", type=int, default=50,
+                        help="NCP state changes to propagate")
+    parser.add_argument("--devices", type=int, default=0,
+                        help="Known devices per fake adapter")
+    parser.add_argument("--services", type=int, default=8,
+                        help="Services up to which the GetManagedObjects"
+                        " handler is timed in process")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    print('\n'.join(bench_managed_objects_scaling(args.services,
+                                                  args.calls)))
+
+    working_dir = tempfile.mkdtemp(prefix='netsetup-bench-')
+    private_bus = fakes.PrivateBus()
+    processes = []
+    try:
+        env = private_bus.get_env()
+        bus = private_bus.connect()
+
+        processes.append(fakes.start(env, devices=args.devices))
+        fakes.wait_for_names(bus, [fakes.wpantun.INTERFACE_SERVICE_DBUS,
+                                   ble.BLUEZ_SERVICE_NAME])
+
+        log = open(os.path.join(working_dir, 'netsetup.log'), 'w')
+        started = time.time()
+        processes.append(fakes.start_daemon(env, working_dir, stderr=log))
+        registrations = fakes.wait_for_registration(bus)
+
+        report = [
+            'Startup to advertisement    %8.3fms' % (
+                (registrations['advertisement_time'] - started) * 1000),
+            'Startup to application      %8.3fms' % (
+                (registrations['application_time'] - started) * 1000),
+        ]
+
+        sender = registrations['application_sender']
+        paths = find_characteristics(bus, sender)
+        report += bench_reads(bus, sender, paths, args.reads)
+        report.append(bench_managed_objects(bus, sender, args.calls))
+        report.append(bench_propagation(
+            bus, sender,
+            paths[ble.find_spec('state').uuid],
+            args.changes))
+
+        print('\n'.join(report))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        private_bus.stop()
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
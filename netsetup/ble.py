@@ -6,11 +6,20 @@
 
 import os
 import sys
+import socket
 import struct
+import zlib
 import logging
 import dbus
+import gobject as GObject
 from dbus.service import method as dbus_method
 
+from . import log
+from . import metrics
+from .timing import PhaseTimer
+from .wpantun import format_key, is_associated
+from .commissioner import JoinerProvisioner
+
 logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
                     stream=sys.stderr, level=logging.INFO)
 
@@ -27,8 +36,10 @@ GATT_DESC_IFACE = 'org.bluez.GattDescriptor1'
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
 LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
 
-
-wpantun = None
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+ADAPTER_IFACES = (ADAPTER_IFACE, GATT_MANAGER_IFACE,
+                  LE_ADVERTISING_MANAGER_IFACE)
 
 
 class InvalidArgsException(dbus.exceptions.DBusException):
@@ -43,6 +54,10 @@ class NotPermittedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.NotPermitted'
 
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
 class InvalidValueLengthException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
 
@@ -51,6 +66,10 @@ class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
 
+class InProgressException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InProgress'
+
+
 class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
@@ -59,6 +78,7 @@ class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
@@ -66,11 +86,27 @@ class Application(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drop the cached GetManagedObjects response after the object tree
+        has changed
+        """
+        self.managed_objects = None
 
     @dbus_method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
+        log.hot.debug('GetManagedObjects')
+        with metrics.measure('GetManagedObjects'):
+            if self.managed_objects is None:
+                self.managed_objects = self.get_managed_objects()
+
+            return self.managed_objects
+
+    def get_managed_objects(self):
         response = {}
-        logging.info('GetManagedObjects')
 
         for service in self.services:
             response[service.get_path()] = service.get_properties()
@@ -96,6 +132,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -114,6 +151,11 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        if self.application is not None:
+            self.application.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -144,6 +186,7 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.subscribers = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -163,6 +206,7 @@ class Characteristic(dbus.service.Object):
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.service.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -180,180 +224,612 @@ class Characteristic(dbus.service.Object):
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
+    def get_value(self):
+        logging.info('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
     @dbus_method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
-        logging.info('Default ReadValue called, returning error')
+        with metrics.measure('ReadValue', self.path):
+            return slice_value(self.get_value(), options)
+
+    def set_value(self, value, options):
+        logging.info('Default WriteValue called, returning error')
         raise NotSupportedException()
 
     @dbus_method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        logging.info('Default WriteValue called, returning error')
-        raise NotSupportedException()
+        with metrics.measure('WriteValue', self.path):
+            self.set_value(value, options)
 
     @dbus_method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        logging.info('Default StartNotify called, returning error')
-        raise NotSupportedException()
+        if 'notify' not in self.flags:
+            logging.info('Default StartNotify called, returning error')
+            raise NotSupportedException()
+
+        self.subscribers += 1
+        logging.info('%s: %d subscribers', self.path, self.subscribers)
 
     @dbus_method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        logging.info('Default StopNotify called, returning error')
-        raise NotSupportedException()
+        if 'notify' not in self.flags:
+            logging.info('Default StopNotify called, returning error')
+            raise NotSupportedException()
+
+        if self.subscribers > 0:
+            self.subscribers -= 1
+        logging.info('%s: %d subscribers', self.path, self.subscribers)
+
+    def notify_value(self, value):
+        """
+        Push a new value to the subscribed clients, if any
+        """
+        if self.subscribers == 0:
+            return
+
+        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
 
     @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
 
-class KnotApplication(Application):
-    def __init__(self, bus):
-        Application.__init__(self, bus)
-        self.add_service(KnotService(bus, 0))
+class CacheEntry(object):
+    """
+    Encoded value of one characteristic and how to rebuild it
+    """
+    __slots__ = ('uuid', 'attr', 'encoder', 'value', 'listeners')
 
+    def __init__(self, uuid, attr, encoder):
+        self.uuid = uuid
+        self.attr = attr
+        self.encoder = encoder
+        self.value = EMPTY_VALUE
+        self.listeners = []
 
-class KnotService(Service):
-    KNOT_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900e30"
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.KNOT_UUID, True)
-        self.add_characteristic(OpenthreadChannelCharacteristic(bus, 0, self))
-        self.add_characteristic(OpenthreadNameCharacteristic(bus, 1, self))
-        self.add_characteristic(OpenthreadPanIDCharacteristic(bus, 2, self))
-        self.add_characteristic(OpenthreadXPanIDCharacteristic(bus, 3, self))
-        self.add_characteristic(OpenthreadMasterKeyCharacteristic(bus, 4,
-                                                                  self))
-        self.add_characteristic(OpenthreadStateCharacteristic(bus, 5, self))
-        self.add_characteristic(OpenthreadMeshIPv6Characteristic(bus, 6, self))
+class ValueCache(object):
+    """
+    Encoded values of the characteristics built from Wpantun. Each entry
+    is rebuilt only when the Wpantun attribute it is encoded from changes,
+    so reads hand back the cached buffer.
+    """
 
+    def __init__(self, wpan):
+        self.wpan = wpan
+        self.entries = {}
+        self.by_attr = {}
+        if self.wpan is not None:
+            self.wpan.add_listener(self._wpantun_changed_cb)
+
+    def register(self, uuid, attr, encoder):
+        """
+        Add the entry of uuid, encoded from the Wpantun attribute attr. attr
+        may also be a tuple of attributes, then encoder receives a tuple
+        of their values.
+        """
+        entry = CacheEntry(uuid, attr, encoder)
+        self.entries[uuid] = entry
+
+        attrs = attr if isinstance(attr, tuple) else (attr,)
+        for name in attrs:
+            self.by_attr.setdefault(name, []).append(entry)
+
+        entry.value = self._encode(entry)
+
+    def _encode(self, entry):
+        if self.wpan is None:
+            return EMPTY_VALUE
+
+        if isinstance(entry.attr, tuple):
+            value = tuple(getattr(self.wpan, name) for name in entry.attr)
+        else:
+            value = getattr(self.wpan, entry.attr)
+        return encode_value(entry.encoder, value)
 
-class OpenthreadChannelCharacteristic(Characteristic):
-    CHANNEL_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d31"
+    def get(self, uuid):
+        return self.entries[uuid].value
 
-    def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.CHANNEL_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in struct.pack(">l", wpantun.channel))
-        else:
-            self.value = []
+    def add_listener(self, uuid, callback):
+        """
+        Register a callback(value) called with the new encoded value
+        whenever the entry of uuid is rebuilt
+        """
+        self.entries[uuid].listeners.append(callback)
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadChannelCharacteristic Read: ' +
-                     repr(self.value))
-        return self.value
+    def _wpantun_changed_cb(self, changes):
+        entries = []
+        for attr in changes:
+            for entry in self.by_attr.get(attr, []):
+                if entry not in entries:
+                    entries.append(entry)
 
+        # Each entry is encoded and announced at most once per batch, and
+        # only if its encoded value is different
+        for entry in entries:
+            value = self._encode(entry)
+            if value == entry.value:
+                continue
 
-class OpenthreadNameCharacteristic(Characteristic):
-    NAME_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d32"
+            entry.value = value
+            for listener in entry.listeners:
+                listener(value)
 
-    def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.NAME_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in bytes(wpantun.network_name))
-        else:
-            self.value = []
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadNameCharacteristic Read: ' + repr(self.value))
-        return self.value
+EMPTY_VALUE = dbus.ByteArray(b'')
 
 
-class OpenthreadPanIDCharacteristic(Characteristic):
-    PANID_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d33"
+def encode_value(encoder, value):
+    """
+    Return the encoded value as a compact byte buffer
+    """
+    if value is None:
+        return EMPTY_VALUE
+    return dbus.ByteArray(encoder(value))
 
-    def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.PANID_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in struct.pack(">H", wpantun.pan_id))
-        else:
-            self.value = []
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadPanIDCharacteristic Read: ' + repr(self.value))
-        return self.value
+def encode_string(value):
+    return value.encode('utf-8')
 
 
-class OpenthreadXPanIDCharacteristic(Characteristic):
-    XPANID_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d34"
+def struct_encoder(fmt):
+    return struct.Struct(fmt).pack
 
-    def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.XPANID_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in struct.pack(">Q", wpantun.xpan_id))
-        else:
-            self.value = []
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadXPanIDCharacteristic Read: ' +
-                     repr(self.value))
-        return self.value
+def encode_masterkey(value):
+    if not value:
+        return b''
+    return bytes(bytearray(int(item, 16) for item in value.split(':')))
 
 
-class OpenthreadMasterKeyCharacteristic(Characteristic):
-    MASTERKEY_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d35"
+def encode_ipv6(value):
+    if not value:
+        return b''
+    return socket.inet_pton(socket.AF_INET6, str(value))
 
-    def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.MASTERKEY_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in bytes(wpantun.masterkey))
-        else:
-            self.value = []
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadMasterKeyCharacteristic Read: ' +
-                     repr(self.value))
-        return self.value
+def struct_decoder(fmt):
+    """
+    Return a decoder of written values packed as fmt, which must be
+    exactly its size
+    """
+    packer = struct.Struct(fmt)
+
+    def decode(value):
+        if len(value) != packer.size:
+            raise InvalidValueLengthException()
+        return packer.unpack(bytes(bytearray(value)))[0]
+    return decode
+
+
+# IEEE 802.15.4 2.4GHz channels used by Thread
+THREAD_CHANNELS = range(11, 27)
+
+
+def decode_channel(value):
+    channel = struct_decoder(">l")(value)
+    if channel not in THREAD_CHANNELS:
+        raise InvalidArgsException()
+    return channel
+
+
+def decode_string(value):
+    # Thread network names are up to 16 bytes long
+    if not 0 < len(value) <= 16:
+        raise InvalidValueLengthException()
+    try:
+        return bytes(bytearray(value)).decode('utf-8')
+    except UnicodeDecodeError:
+        raise InvalidArgsException()
+
+
+def decode_masterkey(value):
+    if len(value) != 16:
+        raise InvalidValueLengthException()
+    return format_key(bytearray(value))
+
+
+# Fields of the network snapshot as (attribute, TLV type, encoder)
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FIELDS = (
+    ("channel", 0x01, struct_encoder(">B")),
+    ("network_name", 0x02, encode_string),
+    ("pan_id", 0x03, struct_encoder(">H")),
+    ("xpan_id", 0x04, struct_encoder(">Q")),
+    ("masterkey", 0x05, encode_masterkey),
+    ("state", 0x06, encode_string),
+    ("mesh_ipv6", 0x07, encode_ipv6),
+    ("stale", 0x08, struct_encoder(">?")),
+)
+SNAPSHOT_ATTRS = tuple(attr for attr, _, _ in SNAPSHOT_FIELDS)
+TLV_HEADER = struct.Struct(">BB")
+
+
+def encode_snapshot(values):
+    """
+    Encode the values of SNAPSHOT_ATTRS as the version byte followed by a
+    (type, length, value) triple for every known field. Type and length
+    take one byte each.
+    """
+    blob = bytearray([SNAPSHOT_VERSION])
+    for (_, tlv_type, encoder), value in zip(SNAPSHOT_FIELDS, values):
+        if value is None:
+            continue
+        data = encoder(value)
+        blob += TLV_HEADER.pack(tlv_type, len(data))
+        blob += data
+    return bytes(blob)
+
+
+def slice_value(value, options):
+    """
+    Return the part of value requested by a (long) read: starting at
+    options['offset'] and no longer than what fits in a single ATT read
+    response for options['mtu']
+    """
+    offset = int(options.get('offset', 0))
+    if offset > len(value):
+        raise InvalidOffsetException()
+
+    end = len(value)
+    mtu = int(options.get('mtu', 0))
+    if mtu > 1:
+        end = min(end, offset + mtu - 1)
+
+    if offset == 0 and end == len(value):
+        return value
+
+    return dbus.ByteArray(value[offset:end])
+
+
+# Joiner entries written to the joiner list characteristic, back to back:
+# the 8 byte EUI-64, one byte with the PSKd length and the PSKd itself
+JOINER_ENTRY = struct.Struct(">8sB")
+# Valid PSKd characters: uppercase alphanumeric but I, O, Q and Z
+PSKD_CHARS = frozenset(bytearray(b"0123456789ABCDEFGHJKLMNPRSTUVWXY"))
+PSKD_LENGTHS = (6, 32)
+
+# Value of the joiner status characteristic: the number of queued, in
+# progress, added and failed joiners, then the EUI-64 and state of the
+# joiner which progressed last
+JOINER_STATUS = struct.Struct(">HHHH8sB")
+
+
+def parse_joiners(data):
+    """
+    Return the complete joiner entries at the start of data, as (EUI-64,
+    PSKd) pairs, and the number of bytes they take. A trailing partial
+    entry is left out.
+    """
+    joiners = []
+    used = 0
+    while len(data) - used >= JOINER_ENTRY.size:
+        eui64, length = JOINER_ENTRY.unpack_from(bytes(data), used)
+        end = used + JOINER_ENTRY.size + length
+        if end > len(data):
+            break
+
+        pskd = bytearray(data[used + JOINER_ENTRY.size:end])
+        if not PSKD_LENGTHS[0] <= length <= PSKD_LENGTHS[1] or \
+                any(char not in PSKD_CHARS for char in pskd):
+            raise InvalidArgsException()
+
+        joiners.append((bytearray(eui64), bytes(pskd).decode('ascii')))
+        used = end
+    return joiners, used
+
+
+class CharacteristicSpec(object):
+    """
+    UUID of a characteristic served from the ValueCache, plus the Wpantun
+    attribute and the encoder its value is built with. Characteristics
+    with a decoder are also writable, see KnotService.stage().
+    """
+    __slots__ = ('uuid', 'attr', 'encoder', 'decoder')
+
+    def __init__(self, uuid, attr, encoder, decoder=None):
+        self.uuid = uuid
+        self.attr = attr
+        self.encoder = encoder
+        self.decoder = decoder
+
+
+# Characteristics of KnotService, in the order they are exported
+OPENTHREAD_CHARACTERISTICS = (
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d31", "channel",
+                       struct_encoder(">l"), decode_channel),
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d32", "network_name",
+                       encode_string, decode_string),
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d33", "pan_id",
+                       struct_encoder(">H"), struct_decoder(">H")),
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d34", "xpan_id",
+                       struct_encoder(">Q"), struct_decoder(">Q")),
+    # Read as the formatted key, written as its 16 raw bytes
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d35", "masterkey",
+                       encode_string, decode_masterkey),
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d36", "state",
+                       encode_string),
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d37", "mesh_ipv6",
+                       encode_string),
+    # Every network parameter in a single read, see encode_snapshot()
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d38", SNAPSHOT_ATTRS,
+                       encode_snapshot),
+    # Name of the wpantund interface, e.g. wpan0, telling apart the
+    # services of a gateway with several NCPs
+    CharacteristicSpec("a8a9e49c-aa9a-d441-9bec-817bb4900d3c", "interface",
+                       encode_string),
+)
+
+
+def find_spec(attr):
+    for spec in OPENTHREAD_CHARACTERISTICS:
+        if spec.attr == attr:
+            return spec
+    return None
+
+
+class KnotApplication(Application):
+    """
+    One KnotService for each wpantund interface, given by their caches
+    """
+
+    def __init__(self, bus, caches):
+        Application.__init__(self, bus)
+        for index, cache in enumerate(caches):
+            self.add_service(KnotService(bus, index, cache))
+
+
+# Opcodes written to the commit characteristic
+COMMIT_ABORT = 0
+COMMIT_JOIN = 1
+COMMIT_FORM = 2
+
+# Result of the last commit, as read from the commit characteristic
+COMMIT_IDLE = 0
+COMMIT_PENDING = 1
+COMMIT_DONE = 2
+COMMIT_FAILED = 3
+
+# Seconds the values staged by a central are kept after its last write
+STAGE_TIMEOUT = 60
+
 
+class KnotService(Service):
+    """
+    Values written to the characteristics are only staged, and applied to
+    wpantund all at once as a join or form when the commit characteristic
+    is written, so a whole configuration takes a single network change.
+    Each central, by device path, stages its own values, dropped when it
+    disconnects or stops writing for STAGE_TIMEOUT seconds.
+    """
+    KNOT_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900e30"
 
-class OpenthreadStateCharacteristic(Characteristic):
-    STATE_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d36"
+    def __init__(self, bus, index, cache):
+        Service.__init__(self, bus, index, self.KNOT_UUID, True)
+        self.cache = cache
+        self.staged = {}
+        self.stage_timers = {}
+        bus.add_signal_receiver(self._device_changed_cb,
+                                signal_name='PropertiesChanged',
+                                dbus_interface=DBUS_PROP_IFACE,
+                                bus_name=BLUEZ_SERVICE_NAME,
+                                arg0=DEVICE_IFACE, path_keyword='path')
+        for i, spec in enumerate(OPENTHREAD_CHARACTERISTICS):
+            self.add_characteristic(OpenthreadCharacteristic(bus, i, self,
+                                                             spec))
+        self.commit_chrc = CommitCharacteristic(
+            bus, len(OPENTHREAD_CHARACTERISTICS), self)
+        self.add_characteristic(self.commit_chrc)
+
+        self.provisioner = None
+        if cache.wpan is not None:
+            self.provisioner = JoinerProvisioner(cache.wpan)
+        index = len(self.characteristics)
+        self.add_characteristic(JoinerListCharacteristic(bus, index, self))
+        self.add_characteristic(JoinerStatusCharacteristic(bus, index + 1,
+                                                           self))
+
+    def stage(self, attr, value, device=None):
+        logging.info('%s: %s staged by %s', self.path, attr, device)
+        self.drop_timer(device)
+        self.staged.setdefault(device, {})[attr] = value
+        self.stage_timers[device] = GObject.timeout_add(
+            STAGE_TIMEOUT * 1000, self._stage_expired_cb, device)
+
+    def drop_staged(self, device):
+        """
+        Drop and return the values staged by device
+        """
+        self.drop_timer(device)
+        return self.staged.pop(device, {})
+
+    def drop_timer(self, device):
+        timer = self.stage_timers.pop(device, None)
+        if timer is not None:
+            GObject.source_remove(timer)
+
+    def _stage_expired_cb(self, device):
+        del self.stage_timers[device]
+        if self.staged.pop(device, None) is not None:
+            logging.info('%s: values staged by %s expired', self.path, device)
+        return False
+
+    def _device_changed_cb(self, interface, changed, invalidated, path=None):
+        if changed.get('Connected', True) or path not in self.staged:
+            return
+
+        logging.info('%s: %s disconnected, staged values dropped',
+                     self.path, path)
+        self.drop_staged(path)
+
+    def commit(self, opcode, device=None):
+        if opcode == COMMIT_ABORT:
+            logging.info('%s: values staged by %s dropped', self.path, device)
+            self.drop_staged(device)
+            return
+
+        if opcode not in (COMMIT_JOIN, COMMIT_FORM):
+            raise InvalidArgsException()
+
+        wpan = self.cache.wpan
+        if wpan is None:
+            raise NotSupportedException()
+        if self.commit_chrc.result == COMMIT_PENDING:
+            raise InProgressException()
+
+        # Values not staged are taken from the current network, but the
+        # cached ones are only meaningful while associated. Form picks the
+        # PAN and extended PAN IDs when left out, join needs them all.
+        required = ['network_name', 'channel']
+        if opcode == COMMIT_JOIN:
+            required += ['pan_id', 'xpan_id']
+        staged = self.staged.get(device, {})
+        values = {}
+        if is_associated(wpan.state):
+            values.update(wpan.get_values())
+        values.update(staged)
+
+        if any(values.get(attr) is None for attr in required) or \
+                not values['network_name'] or \
+                values['channel'] not in THREAD_CHANNELS:
+            raise InvalidArgsException()
+
+        settings = dict((attr, values[attr]) for attr in required)
+        settings.update(self.drop_staged(device))
+        self.commit_chrc.set_result(COMMIT_PENDING)
+        wpan.configure(
+            settings, opcode == COMMIT_FORM,
+            reply_cb=lambda: self.commit_chrc.set_result(COMMIT_DONE),
+            error_cb=lambda error: self.commit_chrc.set_result(
+                COMMIT_FAILED))
+
+
+class OpenthreadCharacteristic(Characteristic):
+    """
+    Characteristic whose value is served from the ValueCache of its
+    service and notified to subscribers when it changes. Writes, where
+    supported, are staged in the service until committed.
+    """
+
+    def __init__(self, bus, index, service, spec):
+        flags = ["read", "notify"]
+        if spec.decoder is not None:
+            # Anyone in range could otherwise rekey the network or move
+            # the gateway to another one
+            flags.append("encrypt-authenticated-write")
+        Characteristic.__init__(self, bus, index, spec.uuid, flags, service)
+        self.spec = spec
+        self.cache = service.cache
+        self.cache.register(spec.uuid, spec.attr, spec.encoder)
+        self.cache.add_listener(spec.uuid, self.notify_value)
+
+    def get_value(self):
+        value = self.cache.get(self.uuid)
+        log.hot.debug('%s Read: %d bytes', self.uuid, len(value))
+        return value
+
+    def set_value(self, value, options):
+        if self.spec.decoder is None:
+            raise NotSupportedException()
+        if int(options.get('offset', 0)):
+            raise InvalidOffsetException()
+        self.service.stage(self.spec.attr, self.spec.decoder(value),
+                           options.get('device'))
+
+
+class CommitCharacteristic(Characteristic):
+    """
+    Writing a one byte opcode applies (COMMIT_JOIN, COMMIT_FORM) or drops
+    (COMMIT_ABORT) the values staged in the service. Reads and
+    notifications give the result of the last commit.
+    """
+    UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d39"
 
     def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.STATE_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in bytes(wpantun.state))
-        else:
-            self.value = []
+        Characteristic.__init__(self, bus, index, self.UUID,
+                                ["read", "encrypt-authenticated-write",
+                                 "notify"], service)
+        self.result = COMMIT_IDLE
+
+    def get_value(self):
+        return dbus.ByteArray(struct.pack(">B", self.result))
+
+    def set_value(self, value, options):
+        if len(value) != 1:
+            raise InvalidValueLengthException()
+        self.service.commit(int(value[0]), options.get('device'))
+
+    def set_result(self, result):
+        self.result = result
+        self.notify_value(self.get_value())
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadStateCharacteristic Read: ' + repr(self.value))
-        return self.value
 
+class JoinerListCharacteristic(Characteristic):
+    """
+    Takes joiner entries, see parse_joiners(), to be provisioned by the
+    service. A long list can be written in several writes, each at the
+    offset following the previous one, and entries may straddle them.
+    A write at offset 0 starts a new list.
+    """
+    UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d3a"
 
-class OpenthreadMeshIPv6Characteristic(Characteristic):
-    MESHIPV6_CHRC_UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d37"
+    def __init__(self, bus, index, service):
+        # Queued joiners may join the network, so only paired and
+        # authenticated centrals may add them
+        Characteristic.__init__(self, bus, index, self.UUID,
+                                ["encrypt-authenticated-write"], service)
+        self.pending = bytearray()
+        self.received = 0
+
+    def set_value(self, value, options):
+        provisioner = self.service.provisioner
+        if provisioner is None:
+            raise NotSupportedException()
+        if not is_associated(provisioner.wpan.state):
+            raise NotPermittedException()
+
+        offset = int(options.get('offset', 0))
+        if offset == 0:
+            self.pending = bytearray()
+            self.received = 0
+        elif offset != self.received:
+            raise InvalidOffsetException()
+
+        data = self.pending + bytearray(value)
+        joiners, used = parse_joiners(data)
+        if not provisioner.add(joiners):
+            raise FailedException()
+
+        self.pending = data[used:]
+        self.received = offset + len(value)
+
+
+class JoinerStatusCharacteristic(Characteristic):
+    """
+    Progress of the joiners, see JOINER_STATUS, notified every time one
+    of them progresses
+    """
+    UUID = "a8a9e49c-aa9a-d441-9bec-817bb4900d3b"
 
     def __init__(self, bus, index, service):
-        global wpantun
-        Characteristic.__init__(self, bus, index, self.MESHIPV6_CHRC_UUID,
-                                ["read"], service)
-        if wpantun is not None:
-            self.value = dbus.Array(
-                dbus.Byte(i) for i in bytes(wpantun.mesh_ipv6))
-        else:
-            self.value = []
+        Characteristic.__init__(self, bus, index, self.UUID,
+                                ["read", "notify"], service)
+        self.provisioner = service.provisioner
+        self.last = (b'\0' * 8, 0)
+        if self.provisioner is not None:
+            self.provisioner.add_listener(self._joiner_changed_cb)
 
-    def ReadValue(self, options):
-        logging.info('OpenthreadMeshIPv6Characteristic Read: ' +
-                     repr(self.value))
-        return self.value
+    def get_value(self):
+        if self.provisioner is None:
+            return EMPTY_VALUE
+        counts = tuple(min(count, 0xffff)
+                       for count in self.provisioner.get_counts())
+        return dbus.ByteArray(JOINER_STATUS.pack(*(counts + self.last)))
+
+    def _joiner_changed_cb(self, eui64, state):
+        self.last = (bytes(eui64), state)
+        self.notify_value(self.get_value())
 
 
 class Advertisement(dbus.service.Object):
@@ -370,6 +846,9 @@ class Advertisement(dbus.service.Object):
         self.local_name = None
         self.include_tx_power = None
         self.data = None
+        self.min_interval = None
+        self.max_interval = None
+        self.tx_power = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -395,6 +874,12 @@ class Advertisement(dbus.service.Object):
         if self.data is not None:
             properties['Data'] = dbus.Dictionary(
                 self.data, signature='yv')
+        if self.min_interval is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval)
+        if self.max_interval is not None:
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval)
+        if self.tx_power is not None:
+            properties['TxPower'] = dbus.Int16(self.tx_power)
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
@@ -425,6 +910,13 @@ class Advertisement(dbus.service.Object):
             self.local_name = ""
         self.local_name = dbus.String(name)
 
+    def set_interval(self, interval):
+        """
+        Advertise every interval milliseconds, or let BlueZ choose if None
+        """
+        self.min_interval = interval
+        self.max_interval = interval
+
     def add_data(self, ad_type, data):
         if not self.data:
             self.data = dbus.Dictionary({}, signature='yv')
@@ -432,79 +924,560 @@ class Advertisement(dbus.service.Object):
 
     @dbus_method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface):
-        logging.info('GetAll')
+        log.hot.debug('GetAll %s', interface)
         if interface != LE_ADVERTISEMENT_IFACE:
             raise InvalidArgsException()
-        logging.info('returning props')
         return self.get_properties()[LE_ADVERTISEMENT_IFACE]
 
     @dbus_method(LE_ADVERTISEMENT_IFACE, in_signature='', out_signature='')
     def Release(self):
         logging.info('%s: Released!' % self.path)
 
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
 
 class KnotAdvertisement(Advertisement):
-    def __init__(self, bus, index, ad_name):
+    """
+    With a status_wpan, the advertisement also carries its network status
+    as manufacturer data, see encode_ad_status(), and is updated whenever
+    it changes
+    """
+    MANUFACTURER_CODE = 0xffff
+
+    def __init__(self, bus, index, ad_name, status_wpan=None):
         Advertisement.__init__(self, bus, index, 'peripheral')
         self.add_service_uuid("a8a9e49c-aa9a-d441-9bec-817bb4900e30")
         self.add_local_name(ad_name)
-        self.include_tx_power = True
 
+        # BlueZ sends the name in the scan response, but the flags and the
+        # service UUID leave no room for both the TX power and the status
+        # within the 31 bytes of the advertising data
+        self.status_wpan = status_wpan
+        if self.status_wpan is None:
+            self.include_tx_power = True
+        if self.status_wpan is not None:
+            self.add_manufacturer_data(self.MANUFACTURER_CODE,
+                                       encode_ad_status(self.status_wpan))
+            self.status_wpan.add_listener(self._wpantun_changed_cb)
+
+    def close(self):
+        if self.status_wpan is not None:
+            self.status_wpan.remove_listener(self._wpantun_changed_cb)
+        dbus.service.Object.remove_from_connection(self)
+
+    def _wpantun_changed_cb(self, changes):
+        if not any(attr in changes for attr in AD_STATUS_ATTRS):
+            return
+
+        data = encode_ad_status(self.status_wpan)
+        if data == bytearray(self.manufacturer_data[self.MANUFACTURER_CODE]):
+            return
+
+        self.add_manufacturer_data(self.MANUFACTURER_CODE, data)
+        self.PropertiesChanged(
+            LE_ADVERTISEMENT_IFACE,
+            {'ManufacturerData': self.manufacturer_data}, [])
+
+
+# NCP states as advertised, any other state is sent as 0xff
+# wpantund NCP states, advertised by their index. Any other state is
+# advertised as 0xff.
+AD_STATES = ("uninitialized", "offline", "offline:commissioned",
+             "associating", "associating:credentials-needed", "associated",
+             "associated:no-parent", "associated:netwake-asleep",
+             "associated:netwake-waking", "uninitialized:fault",
+             "uninitialized:upgrading", "offline:deep-sleep")
+AD_STATUS_ATTRS = ("state", "channel", "pan_id", "xpan_id")
+
+
+def encode_ad_status(wpan):
+    """
+    Encode the network status as the NCP state code, the channel and a
+    16 bit hash of the PAN ID and XPAN ID, one, one and two bytes long
+    """
+    state = wpan.state or ""
+    if state in AD_STATES:
+        code = AD_STATES.index(state)
+    else:
+        code = 0xff
 
-class Ble(object):
-    bus = None
-
-    ad_adapter = None
-    ad_adapter_props = None
-    ad_manager = None
-    ad_knot = None
+    network = struct.pack(">HQ", wpan.pan_id or 0, wpan.xpan_id or 0)
+    pan_hash = zlib.crc32(network) & 0xffff
 
-    gatt_adapter = None
-    gatt_manager = None
-    gatt_knot = None
+    return bytearray(struct.pack(">BBH", code, (wpan.channel or 0) & 0xff,
+                                 pan_hash))
 
-    def __init__(self, wpan, ad_name):
-        global wpantun
 
-        self.bus = dbus.SystemBus()
-        wpantun = wpan
+class AdapterIndex(object):
+    """
+    Index of the BlueZ adapters by interface. It is built from a single
+    GetManagedObjects() scan and kept up to date from the InterfacesAdded
+    and InterfacesRemoved signals, so adapter hot-plug is picked up
+    without scanning again.
+    """
 
-        self.ad_adapter = find_adapter(self.bus, LE_ADVERTISING_MANAGER_IFACE)
-        if not self.ad_adapter:
-            logging.error("LEAdvertiseManager1 interface not found")
+    def __init__(self, bus):
+        self.bus = bus
+        self.adapters = {}
+        self.listeners = []
+
+        # Following the name owner keeps the proxy, and the signal
+        # subscriptions, working across bluetoothd restarts
+        self.remote_om = dbus.Interface(
+            self.bus.get_object(BLUEZ_SERVICE_NAME, '/', introspect=False,
+                                follow_name_owner_changes=True),
+            DBUS_OM_IFACE)
+        self.remote_om.connect_to_signal('InterfacesAdded',
+                                         self._interfaces_added_cb)
+        self.remote_om.connect_to_signal('InterfacesRemoved',
+                                         self._interfaces_removed_cb)
+
+    def scan(self, done_cb, error_cb):
+        """
+        Build the index without blocking, done_cb() is called once it is
+        ready
+        """
+        def reply_cb(objects):
+            self.adapters = {}
+            for o, props in objects.items():
+                self._add(o, props.keys())
+            done_cb()
+
+        self.remote_om.GetManagedObjects(reply_handler=reply_cb,
+                                         error_handler=error_cb)
+
+    def clear(self):
+        self.adapters = {}
+
+    def find(self, iface):
+        """
+        Return the first adapter exposing iface or None
+        """
+        paths = self.adapters.get(iface)
+        if not paths:
+            return None
+        return paths[0]
+
+    def add_listener(self, callback):
+        """
+        Register a callback(added, path, interfaces) called when an adapter
+        gains or loses any of the indexed interfaces
+        """
+        self.listeners.append(callback)
+
+    def _add(self, path, interfaces):
+        interfaces = [i for i in interfaces if i in ADAPTER_IFACES]
+        for iface in interfaces:
+            paths = self.adapters.setdefault(iface, [])
+            if path not in paths:
+                paths.append(path)
+        return interfaces
+
+    def _remove(self, path, interfaces):
+        interfaces = [i for i in interfaces if i in ADAPTER_IFACES]
+        for iface in interfaces:
+            paths = self.adapters.get(iface, [])
+            if path in paths:
+                paths.remove(path)
+        return interfaces
+
+    def _interfaces_added_cb(self, path, interfaces):
+        interfaces = self._add(path, interfaces.keys())
+        if not interfaces:
+            return
+
+        logging.info('Adapter %s added: %s', path, ', '.join(interfaces))
+        for listener in self.listeners:
+            listener(True, path, interfaces)
+
+    def _interfaces_removed_cb(self, path, interfaces):
+        interfaces = self._remove(path, interfaces)
+        if not interfaces:
+            return
+
+        logging.info('Adapter %s removed: %s', path, ', '.join(interfaces))
+        for listener in self.listeners:
+            listener(False, path, interfaces)
+
+
+class AdapterRegistration(object):
+    """
+    Advertisement and GATT application registered on a single adapter
+    """
 
-        self.ad_adapter_props = dbus.Interface(
-            self.bus.get_object(BLUEZ_SERVICE_NAME, self.ad_adapter),
-            "org.freedesktop.DBus.Properties")
+    def __init__(self, ble, path):
+        self.ble = ble
+        self.path = path
+        self.name = os.path.basename(path)
+        self.adapter = ble.bus.get_object(BLUEZ_SERVICE_NAME, path,
+                                          introspect=False)
+
+        self.ad_manager = None
+        self.ad_knot = None
+        self.powered = False
+        self.ad_registered = False
+        self.ad_pending = False
+        self.ad_dirty = False
+        self.gatt_manager = None
+        self.gatt_registered = False
+
+    def setup_advertising(self, ad_knot):
+        """
+        Power the adapter and register ad_knot once it is powered
+        """
+        self.ad_knot = ad_knot
+        self.ad_manager = dbus.Interface(self.adapter,
+                                         LE_ADVERTISING_MANAGER_IFACE)
+        self.powered = False
+
+        self.ble.start_phase('adapter power ' + self.name)
+        adapter_props = dbus.Interface(self.adapter, DBUS_PROP_IFACE)
+        adapter_props.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(1),
+                          signature='ssv',
+                          reply_handler=self._powered_reply_cb,
+                          error_handler=self._powered_error_cb)
+
+    def setup_gatt(self):
+        self.gatt_manager = dbus.Interface(self.adapter, GATT_MANAGER_IFACE)
+        self.register_application()
+
+    def drop_advertising(self):
+        """
+        Forget the advertisement after the adapter has lost its
+        LEAdvertisingManager1, BlueZ drops the registration along with it
+        """
+        ad_knot = self.ad_knot
+        self.ad_manager = None
+        self.ad_knot = None
+        self.powered = False
+        self.ad_registered = False
+        return ad_knot
+
+    def drop_gatt(self):
+        self.gatt_manager = None
+        self.gatt_registered = False
+
+    def is_registered(self):
+        """
+        Return whether everything this adapter serves is registered
+        """
+        if self.gatt_manager is not None and not self.gatt_registered:
+            return False
+        return self.ad_manager is None or not self.ble.ad_enabled or \
+            self.ad_registered
+
+    def register_advertisement(self):
+        if self.ad_manager is None or not self.ble.ad_enabled:
+            return
+
+        self.ad_pending = True
+        self.ble.start_phase('register advertisement ' + self.name)
+        self.ad_manager.RegisterAdvertisement(
+            self.ad_knot.get_path(), {}, signature='oa{sv}',
+            reply_handler=self._register_ad_reply_cb,
+            error_handler=self._register_ad_error_cb)
+
+    def refresh_advertisement(self):
+        """
+        Register the advertisement again so BlueZ applies its new settings,
+        or leave it unregistered while advertising is disabled. Nothing is
+        done until the adapter is powered, it is registered then.
+        """
+        if self.ad_manager is None or not self.powered:
+            return
+
+        if self.ad_pending:
+            self.ad_dirty = True
+        elif self.ad_registered:
+            self.ad_pending = True
+            self.ad_manager.UnregisterAdvertisement(
+                self.ad_knot.get_path(), signature='o',
+                reply_handler=self._unregister_ad_reply_cb,
+                error_handler=self._unregister_ad_error_cb)
+        else:
+            self.register_advertisement()
+
+    def register_application(self):
+        if self.gatt_manager is None:
+            return
+
+        self.ble.start_phase('register application ' + self.name)
+        self.gatt_manager.RegisterApplication(
+            self.ble.gatt_knot.get_path(), {}, signature='oa{sv}',
+            reply_handler=self._register_gatt_reply_cb,
+            error_handler=self._register_gatt_error_cb)
+
+    def unregister(self):
+        if self.gatt_manager is not None:
+            self.gatt_manager.UnregisterApplication(self.ble.gatt_knot)
+        if self.ad_manager is not None and self.ad_registered:
+            self.ad_manager.UnregisterAdvertisement(self.ad_knot)
+
+    def _powered_reply_cb(self):
+        self.powered = True
+        self.refresh_advertisement()
+        self.ble.stop_phase('adapter power ' + self.name)
+
+    # Registration errors are not fatal: when bluetoothd or the adapter
+    # comes back, NameOwnerChanged or InterfacesAdded registers again
+
+    def _powered_error_cb(self, error):
+        logging.error('Failed to power %s: %s', self.name, error)
+        self.ble.stop_phase('adapter power ' + self.name)
+
+    def _register_ad_reply_cb(self):
+        logging.info('Advertisement registered on %s', self.name)
+        self.ble.stop_phase('register advertisement ' + self.name)
+        self.ad_registered = True
+        self._ad_done()
+        self.ble.check_registered()
+
+    def _register_ad_error_cb(self, error):
+        logging.error('Failed to register advertisement on %s: %s',
+                      self.name, error)
+        self.ble.stop_phase('register advertisement ' + self.name)
+        self._ad_done()
+
+    def _unregister_ad_reply_cb(self):
+        logging.info('Advertisement unregistered from %s', self.name)
+        self.ad_registered = False
+        self.ad_pending = False
+        if self.ble.ad_enabled:
+            self.register_advertisement()
+        else:
+            self._ad_done()
 
-        self.ad_adapter_props.Set("org.bluez.Adapter1",
-                                  "Powered", dbus.Boolean(1))
+    def _unregister_ad_error_cb(self, error):
+        logging.error('Failed to unregister advertisement: ' + str(error))
+        self._ad_done()
 
-        self.ad_manager = dbus.Interface(
-            self.bus.get_object(BLUEZ_SERVICE_NAME,
-                                self.ad_adapter),
-            LE_ADVERTISING_MANAGER_IFACE)
+    def _ad_done(self):
+        self.ad_pending = False
+        if self.ad_dirty:
+            self.ad_dirty = False
+            self.refresh_advertisement()
 
-        self.ad_knot = KnotAdvertisement(self.bus, 0, ad_name)
+    def _register_gatt_reply_cb(self):
+        logging.info('GATT application registered on %s', self.name)
+        self.ble.stop_phase('register application ' + self.name)
+        self.gatt_registered = True
+        self.ble.check_registered()
 
-        self.gatt_adapter = find_adapter(self.bus, GATT_MANAGER_IFACE)
-        if not self.gatt_adapter:
-            logging.error("GattManager1 interface not found")
+    def _register_gatt_error_cb(self, error):
+        logging.error('Failed to register application on %s: %s',
+                      self.name, error)
+        self.ble.stop_phase('register application ' + self.name)
 
-        self.gatt_manager = dbus.Interface(
-            self.bus.get_object(BLUEZ_SERVICE_NAME, self.gatt_adapter),
-            GATT_MANAGER_IFACE)
 
-        self.gatt_knot = KnotApplication(self.bus)
+class Ble(object):
+    """
+    Serve the KNoT GATT application and advertisement through BlueZ.
+
+    By default only the first adapter is used. With all_adapters, or a list
+    of adapter_names such as ["hci0", "hci1"], every matching adapter gets
+    its own advertisement and the GATT application registered, all of them
+    sharing the same value caches. There is one cache, and one KnotService,
+    for each Wpantun in wpans. With ad_status, the advertisements carry the
+    network status of the first one.
+    """
+    bus = None
+    adapters = None
 
+    gatt_knot = None
 
-def find_adapter(bus, iface):
-    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'),
-                               DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+    caches = None
 
-    for o, props in objects.items():
-        if iface in props.keys():
-            return o
+    def __init__(self, wpans, ad_name, adapter_names=None,
+                 all_adapters=False, ad_status=False):
+        self.bus = dbus.SystemBus()
+        self.caches = [ValueCache(wpan) for wpan in wpans]
+        self.ad_name = ad_name
+        self.status_wpan = wpans[0] if ad_status and wpans else None
+        self.adapter_names = adapter_names
+        self.all_adapters = all_adapters
+        self.timer = None
+
+        self.registrations = {}
+        self.ad_index = 0
+        self.ad_enabled = True
+        self.ad_interval = None
+        self.ad_tx_power = None
+
+        self.gatt_knot = KnotApplication(self.bus, self.caches)
+
+        self.adapters = AdapterIndex(self.bus)
+        self.adapters.add_listener(self._adapters_changed_cb)
+
+        self.owner = None
+        self.recovery = None
+        self.bus.watch_name_owner(BLUEZ_SERVICE_NAME,
+                                  self._name_owner_changed_cb)
+
+    def _name_owner_changed_cb(self, owner):
+        """
+        Register everything again, keeping the cached values, when
+        bluetoothd comes back after a restart
+        """
+        previous = self.owner
+        self.owner = owner
+        if previous is None or bool(previous) == bool(owner):
+            return
+
+        if not owner:
+            logging.info('bluetoothd left the bus')
+            self.recovery = PhaseTimer('Bluetooth recovery',
+                                       self._recovered_cb)
+            self.recovery.start('bluetoothd restart')
+            self._drop_registrations()
+            return
+
+        logging.info('bluetoothd is back')
+        recovery = self.recovery or PhaseTimer('Bluetooth registration')
+        self.recovery = None
+        # bluetoothd may claim its name before exporting the adapters, so
+        # the recovery only ends once everything is registered again
+        recovery.start('registration')
+        self.start(recovery)
+        recovery.stop('bluetoothd restart')
+
+    def _recovered_cb(self, total):
+        metrics.registry.get('recovery', 'bluetoothd').observe(total)
+
+    def _drop_registrations(self):
+        """
+        Forget the registrations, BlueZ dropped them when it exited
+        """
+        for ad_knot in self.get_advertisements():
+            ad_knot.close()
+        self.registrations = {}
+        self.adapters.clear()
+
+        # The centrals were disconnected along with bluetoothd, they
+        # subscribe again once they reconnect
+        for service in self.gatt_knot.services:
+            for chrc in service.get_characteristics():
+                chrc.subscribers = 0
+
+    def start(self, timer=None):
+        """
+        Find the adapters, power them and register the advertisements and
+        the GATT application without blocking. The independent steps run
+        in parallel and are recorded in timer, if given.
+        """
+        self.timer = timer
+        self.start_phase('adapter scan')
+        self.adapters.scan(self._adapters_scanned_cb,
+                           self._adapters_scan_error_cb)
+
+    def start_phase(self, phase):
+        if self.timer is not None:
+            self.timer.start(phase)
+
+    def stop_phase(self, phase):
+        if self.timer is not None:
+            self.timer.stop(phase)
+
+    def check_registered(self):
+        """
+        Close the registration phase once the advertisement and the
+        application are registered on every adapter served
+        """
+        if self.registrations and all(reg.is_registered()
+                                      for reg in self.registrations.values()):
+            self.stop_phase('registration')
+
+    def set_advertising(self, enabled, interval=None, tx_power=None):
+        """
+        Turn advertising on, every interval milliseconds at tx_power dBm
+        when given, or off on every adapter
+        """
+        self.ad_enabled = enabled
+        self.ad_interval = interval
+        self.ad_tx_power = tx_power
+
+        for reg in self.registrations.values():
+            if reg.ad_knot is None:
+                continue
+            self._apply_ad_settings(reg.ad_knot)
+            reg.refresh_advertisement()
+
+    def _apply_ad_settings(self, ad_knot):
+        ad_knot.set_interval(self.ad_interval)
+        ad_knot.tx_power = self.ad_tx_power
+
+    def get_advertisements(self):
+        return [reg.ad_knot for reg in self.registrations.values()
+                if reg.ad_knot is not None]
+
+    def _adapters_scanned_cb(self):
+        self._sync()
+        self.stop_phase('adapter scan')
+
+    def _adapters_scan_error_cb(self, error):
+        # bluetoothd is not up yet, it is scanned again once it is
+        logging.error('Failed to list adapters: ' + str(error))
+        self.stop_phase('adapter scan')
+
+    def _adapters_changed_cb(self, added, path, interfaces):
+        self._sync()
+
+    def _wanted(self, iface):
+        """
+        Return the adapters that should serve iface
+        """
+        paths = self.adapters.adapters.get(iface, [])
+        if self.all_adapters:
+            return list(paths)
+        if self.adapter_names:
+            return [p for p in paths
+                    if os.path.basename(p) in self.adapter_names]
+        return paths[:1]
+
+    def _get_registration(self, path):
+        if path not in self.registrations:
+            self.registrations[path] = AdapterRegistration(self, path)
+        return self.registrations[path]
+
+    def _sync(self):
+        """
+        Bring the registrations in line with the indexed adapters
+        """
+        advertising = self._wanted(LE_ADVERTISING_MANAGER_IFACE)
+        gatt = self._wanted(GATT_MANAGER_IFACE)
+
+        if not advertising:
+            logging.error("LEAdvertiseManager1 interface not found")
+        if not gatt:
+            logging.error("GattManager1 interface not found")
 
-    return None
+        for path, reg in list(self.registrations.items()):
+            if reg.ad_manager is not None and path not in advertising:
+                reg.drop_advertising().close()
+            if reg.gatt_manager is not None and path not in gatt:
+                reg.drop_gatt()
+            if reg.ad_manager is None and reg.gatt_manager is None:
+                del self.registrations[path]
+
+        for path in advertising:
+            reg = self._get_registration(path)
+            if reg.ad_manager is None:
+                ad_knot = KnotAdvertisement(self.bus, self.ad_index,
+                                            self.ad_name, self.status_wpan)
+                self._apply_ad_settings(ad_knot)
+                reg.setup_advertising(ad_knot)
+                self.ad_index += 1
+
+        for path in gatt:
+            reg = self._get_registration(path)
+            if reg.gatt_manager is None:
+                reg.setup_gatt()
+
+    def unregister(self):
+        for reg in self.registrations.values():
+            reg.unregister()
+
+        dbus.service.Object.remove_from_connection(self.gatt_knot)
+        for ad_knot in self.get_advertisements():
+            ad_knot.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import sys
+import logging
+import binascii
+import functools
+import collections
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+# Progress of a joiner, as reported to the listeners
+JOINER_QUEUED = 0
+JOINER_ADDING = 1
+JOINER_ADDED = 2
+JOINER_FAILED = 3
+JOINER_STATES = (JOINER_QUEUED, JOINER_ADDING, JOINER_ADDED, JOINER_FAILED)
+
+# JoinerAdd calls in flight at once
+JOINER_CONCURRENCY = 4
+
+# Seconds a joiner is allowed to join for once added
+JOINER_TIMEOUT = 120
+
+# Joiners waiting to be added, further ones are refused
+MAX_QUEUED = 1000
+
+
+class JoinerProvisioner(object):
+    """
+    Feed joiners, as (EUI-64, PSKd) pairs, to the commissioner of a
+    Wpantun, starting it first if needed, with at most concurrency
+    JoinerAdd calls in flight. Each listener(eui64, state) is told about
+    the progress of every joiner.
+    """
+
+    def __init__(self, wpan, concurrency=JOINER_CONCURRENCY,
+                 timeout=JOINER_TIMEOUT, max_queued=MAX_QUEUED):
+        self.wpan = wpan
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self.queue = collections.deque()
+        self.active = 0
+        self.added = 0
+        self.failed = 0
+        self.commissioner = False
+        self.starting = False
+        self.listeners = []
+        self.wpan.add_listener(self._wpantun_changed_cb)
+
+    def _wpantun_changed_cb(self, changes):
+        # wpantund stops the commissioner whenever the NCP leaves the
+        # network, so it is started again for the next joiners
+        if "state" in changes:
+            self.commissioner = False
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def get_counts(self):
+        """
+        Return the number of queued, in progress, added and failed joiners
+        """
+        return len(self.queue), self.active, self.added, self.failed
+
+    def add(self, joiners):
+        """
+        Queue joiners. Return False, and queue none of them, if they do
+        not fit in the queue.
+        """
+        if len(self.queue) + len(joiners) > self.max_queued:
+            return False
+
+        for eui64, pskd in joiners:
+            self.queue.append((eui64, pskd))
+            self._report(eui64, JOINER_QUEUED)
+        self._pump()
+        return True
+
+    def _pump(self):
+        if not self.queue:
+            return
+
+        if not self.commissioner:
+            if not self.starting:
+                self.starting = True
+                self.wpan.start_commissioner(self._started_cb,
+                                             self._start_failed_cb)
+            return
+
+        while self.queue and self.active < self.concurrency:
+            eui64, pskd = self.queue.popleft()
+            self.active += 1
+            self._report(eui64, JOINER_ADDING)
+            self.wpan.add_joiner(
+                eui64, pskd, self.timeout,
+                functools.partial(self._done_cb, eui64, JOINER_ADDED),
+                functools.partial(self._failed_cb, eui64))
+
+    def _started_cb(self):
+        logging.info('%s: commissioner started', self.wpan.interface)
+        self.starting = False
+        self.commissioner = True
+        self._pump()
+
+    def _start_failed_cb(self, error):
+        self.starting = False
+        while self.queue:
+            eui64, pskd = self.queue.popleft()
+            self.failed += 1
+            self._report(eui64, JOINER_FAILED)
+
+    def _failed_cb(self, eui64, error):
+        self._done_cb(eui64, JOINER_FAILED)
+
+    def _done_cb(self, eui64, state):
+        self.active -= 1
+        if state == JOINER_ADDED:
+            self.added += 1
+        else:
+            self.failed += 1
+        self._report(eui64, state)
+        self._pump()
+
+    def _report(self, eui64, state):
+        logging.debug('%s: joiner %s state %d', self.wpan.interface,
+                      binascii.hexlify(bytes(eui64)), state)
+        for listener in self.listeners:
+            listener(eui64, state)
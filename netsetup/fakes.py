@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Stand-ins for wpantund and BlueZ, so the daemon can be run and measured
+on a private bus without any radio hardware
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import argparse
+import subprocess
+import dbus
+import dbus.bus
+import dbus.service
+import dbus.mainloop.glib
+import gobject as GObject
+from dbus.service import method as dbus_method
+
+from . import wpantun
+from . import ble
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+FAKE_IFACE = 'org.knot.netsetup.Fake1'
+DEVICE_IFACE = 'org.bluez.Device1'
+
+MASTERKEY = bytearray(range(16))
+
+
+def default_status(index=0):
+    return {
+        "NCP:State": dbus.String("associated"),
+        "Network:NodeType": dbus.String("leader"),
+        "Network:Name": dbus.String("KNoT%d" % index),
+        "Network:PANID": dbus.UInt16(0x1234 + index),
+        "NCP:Channel": dbus.UInt32(11 + index),
+        "Network:XPANID": dbus.UInt64(0xdead00beef00cafe + index),
+        "IPv6:MeshLocalAddress": dbus.String("fd00:%x::1" % index),
+    }
+
+
+class PrivateBus(object):
+    """
+    dbus-daemon running for the lifetime of the object. Processes started
+    with get_env() use it as their system bus.
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+            stdout=subprocess.PIPE)
+        self.address = self.process.stdout.readline().strip().decode()
+
+    def get_env(self):
+        env = dict(os.environ)
+        env["DBUS_SYSTEM_BUS_ADDRESS"] = self.address
+        return env
+
+    def connect(self):
+        return dbus.bus.BusConnection(self.address)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class FakeWpantund(dbus.service.Object):
+    """
+    org.wpantund.v1 interface of a single NCP. SetProperty() changes a
+    property and emits PropertyChanged like wpantund does.
+    """
+
+    def __init__(self, bus, interface, index=0):
+        self.path = wpantun.INTERFACE_DBUS_PATH + interface
+        self.properties = default_status(index)
+        self.masterkey = MASTERKEY
+        self.joiners = {}
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    @dbus_method(wpantun.INTERFACE_DBUS, out_signature='a{sv}')
+    def Status(self):
+        return dbus.Dictionary(self.properties, signature='sv')
+
+    @dbus_method(wpantun.INTERFACE_DBUS, in_signature='s',
+                 out_signature='iv')
+    def PropGet(self, key):
+        if key == "Network:Key":
+            return (0, dbus.Array(self.masterkey, signature='y'))
+        return (0, self.properties.get(key, ""))
+
+    @dbus_method(wpantun.INTERFACE_DBUS, in_signature='sv',
+                 out_signature='i')
+    def PropSet(self, key, value):
+        if key == "Network:Key":
+            self.masterkey = bytearray(value)
+            self.PropertyChanged(key, dbus.Array(self.masterkey,
+                                                 signature='y'))
+        else:
+            self.SetProperty(key, value)
+        return 0
+
+    @dbus_method(wpantun.INTERFACE_DBUS, in_signature='sntqu',
+                 out_signature='i')
+    def Join(self, name, node_type, xpan_id, pan_id, channel):
+        self.SetProperty("Network:Name", dbus.String(name))
+        self.SetProperty("Network:XPANID", dbus.UInt64(xpan_id))
+        self.SetProperty("Network:PANID", dbus.UInt16(pan_id))
+        self.SetProperty("NCP:Channel", dbus.UInt32(channel))
+        self.SetProperty("NCP:State", dbus.String("associated"))
+        return 0
+
+    @dbus_method(wpantun.INTERFACE_DBUS, in_signature='suay',
+                 out_signature='i')
+    def JoinerAdd(self, pskd, timeout, eui64):
+        if self.properties.get("Commissioner:State") != "active":
+            return -1
+        self.joiners[bytes(bytearray(eui64))] = pskd
+        return 0
+
+    @dbus_method(wpantun.INTERFACE_DBUS, in_signature='snu',
+                 out_signature='i')
+    def Form(self, name, node_type, channel_mask):
+        channel = max(i for i in range(32) if channel_mask & (1 << i))
+        self.SetProperty("Network:Name", dbus.String(name))
+        self.SetProperty("NCP:Channel", dbus.UInt32(channel))
+        self.SetProperty("NCP:State", dbus.String("associated"))
+        return 0
+
+    @dbus_method(FAKE_IFACE, in_signature='sv')
+    def SetProperty(self, key, value):
+        self.properties[key] = value
+        self.PropertyChanged(key, value)
+
+    @dbus.service.signal(wpantun.INTERFACE_DBUS, signature='sv')
+    def PropertyChanged(self, key, value):
+        pass
+
+
+class FakeObjectManager(dbus.service.Object):
+    """
+    BlueZ object manager listing the fake adapters, plus as many known
+    devices as a busy gateway would have
+    """
+
+    def __init__(self, bus, adapters, devices):
+        self.objects = {}
+        for adapter in adapters:
+            self.objects[adapter.get_path()] = adapter.get_interfaces()
+            for i in range(devices):
+                path = '%s/dev_00_00_00_00_%02X_%02X' % (adapter.path,
+                                                         i >> 8, i & 0xff)
+                self.objects[dbus.ObjectPath(path)] = {
+                    DEVICE_IFACE: {'Address': dbus.String(path[-17:])}}
+        dbus.service.Object.__init__(self, bus, '/')
+
+    @dbus_method(ble.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return self.objects
+
+    @dbus.service.signal(ble.DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(ble.DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+
+class FakeAdapter(dbus.service.Object):
+    """
+    BlueZ adapter exposing GattManager1 and LEAdvertisingManager1. It
+    records when and by whom the application and advertisement were
+    registered, see GetRegistrations().
+    """
+
+    def __init__(self, bus, index):
+        self.path = '/org/bluez/hci%d' % index
+        self.powered = False
+        self.registrations = {}
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def get_interfaces(self):
+        return {
+            ble.ADAPTER_IFACE: {'Powered': dbus.Boolean(self.powered)},
+            ble.GATT_MANAGER_IFACE: dbus.Dictionary({}, signature='sv'),
+            ble.LE_ADVERTISING_MANAGER_IFACE: dbus.Dictionary(
+                {}, signature='sv'),
+        }
+
+    @dbus_method(ble.DBUS_PROP_IFACE, in_signature='ssv')
+    def Set(self, interface, name, value):
+        if interface == ble.ADAPTER_IFACE and name == 'Powered':
+            self.powered = bool(value)
+
+    @dbus_method(ble.GATT_MANAGER_IFACE, in_signature='oa{sv}',
+                 sender_keyword='sender')
+    def RegisterApplication(self, path, options, sender=None):
+        self.registrations['application'] = dbus.String(path)
+        self.registrations['application_sender'] = dbus.String(sender)
+        self.registrations['application_time'] = dbus.Double(time.time())
+
+    @dbus_method(ble.GATT_MANAGER_IFACE, in_signature='o')
+    def UnregisterApplication(self, path):
+        self.registrations.pop('application', None)
+
+    @dbus_method(ble.LE_ADVERTISING_MANAGER_IFACE, in_signature='oa{sv}',
+                 sender_keyword='sender')
+    def RegisterAdvertisement(self, path, options, sender=None):
+        self.registrations['advertisement'] = dbus.String(path)
+        self.registrations['advertisement_time'] = dbus.Double(time.time())
+
+    @dbus_method(ble.LE_ADVERTISING_MANAGER_IFACE, in_signature='o')
+    def UnregisterAdvertisement(self, path):
+        self.registrations.pop('advertisement', None)
+
+    @dbus_method(FAKE_IFACE, out_signature='a{sv}')
+    def GetRegistrations(self):
+        return dbus.Dictionary(self.registrations, signature='sv')
+
+
+def wait_for_names(bus, names, timeout=10):
+    deadline = time.time() + timeout
+    while not all(bus.name_has_owner(name) for name in names):
+        if time.time() > deadline:
+            raise RuntimeError('Timeout waiting for ' + ', '.join(names))
+        time.sleep(0.01)
+
+
+def wait_for_registration(bus, adapter=0, timeout=30):
+    """
+    Wait until the daemon has registered both the advertisement and the
+    application on the fake adapter and return its registrations
+    """
+    fake = dbus.Interface(
+        bus.get_object(ble.BLUEZ_SERVICE_NAME, '/org/bluez/hci%d' % adapter),
+        FAKE_IFACE)
+    deadline = time.time() + timeout
+    while True:
+        registrations = fake.GetRegistrations()
+        if 'application' in registrations and \
+                'advertisement' in registrations:
+            return registrations
+        if time.time() > deadline:
+            raise RuntimeError('Timeout waiting for the daemon to register')
+        time.sleep(0.01)
+
+
+def start(env, interfaces=1, adapters=1, devices=0):
+    """
+    Run the fakes in a child process on the bus of env
+    """
+    return subprocess.Popen(
+        [sys.executable, "-m", "netsetup.fakes",
+         "--interfaces", str(interfaces),
+         "--adapters", str(adapters),
+         "--devices", str(devices)],
+        env=env)
+
+
+def start_daemon(env, working_dir, args=None, stderr=None):
+    """
+    Run the netsetup daemon, without detaching, on the bus of env
+    """
+    return subprocess.Popen(
+        [sys.executable, "-m", "netsetup", "-n",
+         "-w", working_dir,
+         "-p", os.path.join(working_dir, "netsetup"),
+         "-t", os.path.join(working_dir, "netsetup.state")] +
+        list(args or []),
+        env=env, stderr=stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fake wpantund and BlueZ for KNoT NetSetup")
+    parser.add_argument("--interfaces", type=int, default=1,
+                        help="Number of wpantund interfaces")
+    parser.add_argument("--adapters", type=int, default=1,
+                        help="Number of Bluetooth adapters")
+    parser.add_argument("--devices", type=int, default=0,
+                        help="Number of known devices per adapter")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+
+    wpantund_name = dbus.service.BusName(wpantun.INTERFACE_SERVICE_DBUS, bus)
+    fake_ncps = [FakeWpantund(bus, 'wpan%d' % i, i)
+                 for i in range(args.interfaces)]
+
+    fake_adapters = [FakeAdapter(bus, i) for i in range(args.adapters)]
+    fake_om = FakeObjectManager(bus, fake_adapters, args.devices)
+    bluez_name = dbus.service.BusName(ble.BLUEZ_SERVICE_NAME, bus)
+
+    mainloop = GObject.MainLoop()
+    signal.signal(signal.SIGTERM, lambda *args: mainloop.quit())
+    mainloop.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Load generator simulating many BLE centrals, each on its own connection,
+against the netsetup daemon on a private bus with fake wpantund and BlueZ.
+Run with: netsetup-loadgen --clients 50
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import functools
+import dbus
+import dbus.mainloop.glib
+import gobject as GObject
+
+from . import ble
+from . import fakes
+from .bench import summarize, find_characteristics
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+# Seconds to wait for the daemon to answer a call
+CALL_TIMEOUT = 10
+
+
+class Client(object):
+    """
+    A simulated central issuing each operation at its own rate, in calls
+    per second, without waiting for the previous calls to be answered
+    """
+
+    def __init__(self, bus, sender, paths, stats, rates):
+        self.bus = bus
+        self.sender = sender
+        self.stats = stats
+        self.rates = rates
+        self.sources = {}
+        self.chrcs = [dbus.Interface(bus.get_object(sender, path,
+                                                    introspect=False),
+                                     ble.GATT_CHRC_IFACE)
+                      for path in sorted(paths)]
+        self.om = dbus.Interface(bus.get_object(sender, '/',
+                                                introspect=False),
+                                 ble.DBUS_OM_IFACE)
+        self.notifying = False
+
+    def start(self):
+        for op, rate in self.rates.items():
+            if rate <= 0:
+                continue
+            # Spread the clients so they do not all call at the same time
+            interval = int(1000 / rate)
+            self.sources[op] = GObject.timeout_add(
+                random.randint(0, interval), self._first_call_cb, op,
+                interval)
+
+    def stop(self):
+        for source in self.sources.values():
+            GObject.source_remove(source)
+        self.sources = {}
+
+    def _first_call_cb(self, op, interval):
+        self.sources[op] = GObject.timeout_add(interval, self._call_cb, op)
+        self._call_cb(op)
+        return False
+
+    def _call_cb(self, op):
+        started = time.time()
+        kwargs = {
+            'timeout': CALL_TIMEOUT,
+            'reply_handler': functools.partial(self._reply_cb, op, started),
+            'error_handler': functools.partial(self._error_cb, op, started),
+        }
+
+        if op == 'read':
+            random.choice(self.chrcs).ReadValue(
+                dbus.Dictionary({}, signature='sv'), signature='a{sv}',
+                **kwargs)
+        elif op == 'notify':
+            # Alternate subscribing and unsubscribing the same way a
+            # central coming and going would
+            chrc = self.chrcs[0]
+            if self.notifying:
+                chrc.StopNotify(**kwargs)
+            else:
+                chrc.StartNotify(**kwargs)
+            self.notifying = not self.notifying
+        else:
+            self.om.GetManagedObjects(**kwargs)
+        return True
+
+    def _reply_cb(self, op, started, *args):
+        self.stats[op].append(time.time() - started)
+
+    def _error_cb(self, op, started, error):
+        self.stats[op + ' errors'].append(time.time() - started)
+
+
+def read_rss(pid):
+    """
+    Return the current and peak resident set size of pid, in kB, from
+    /proc/<pid>/status
+    """
+    values = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                values[key] = int(value.split()[0])
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def run(private_bus, sender, paths, args):
+    stats = dict((name, []) for op in ('read', 'notify', 'managed')
+                 for name in (op, op + ' errors'))
+    rates = {'read': args.read_rate, 'notify': args.notify_rate,
+             'managed': args.managed_rate}
+
+    clients = [Client(private_bus.connect(), sender, paths, stats, rates)
+               for i in range(args.clients)]
+
+    mainloop = GObject.MainLoop()
+    for client in clients:
+        client.start()
+
+    def done_cb():
+        mainloop.quit()
+        return False
+
+    started = time.time()
+    GObject.timeout_add(int(args.duration * 1000), done_cb)
+    mainloop.run()
+    elapsed = time.time() - started
+
+    for client in clients:
+        client.stop()
+        client.bus.close()
+
+    return stats, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="KNoT NetSetup Daemon load generator")
+    parser.add_argument("--clients", type=int, default=10,
+                        help="Concurrent simulated centrals")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="Seconds to run the load for")
+    parser.add_argument("--read-rate", type=float, default=10,
+                        help="ReadValue calls per second per client")
+    parser.add_argument("--notify-rate", type=float, default=1,
+                        help="StartNotify/StopNotify calls per second"
+                        " per client")
+    parser.add_argument("--managed-rate", type=float, default=0.2,
+                        help="GetManagedObjects calls per second per client")
+    parser.add_argument("--devices", type=int, default=0,
+                        help="Known devices per fake adapter")
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+    working_dir = tempfile.mkdtemp(prefix='netsetup-loadgen-')
+    private_bus = fakes.PrivateBus()
+    processes = []
+    try:
+        env = private_bus.get_env()
+        bus = private_bus.connect()
+
+        processes.append(fakes.start(env, devices=args.devices))
+        fakes.wait_for_names(bus, [fakes.wpantun.INTERFACE_SERVICE_DBUS,
+                                   ble.BLUEZ_SERVICE_NAME])
+
+        log = open(os.path.join(working_dir, 'netsetup.log'), 'w')
+        daemon = fakes.start_daemon(env, working_dir, stderr=log)
+        processes.append(daemon)
+        sender = fakes.wait_for_registration(bus)['application_sender']
+        paths = list(find_characteristics(bus, sender).values())
+        idle_rss, _ = read_rss(daemon.pid)
+
+        stats, elapsed = run(private_bus, sender, paths, args)
+        rss, peak_rss = read_rss(daemon.pid)
+
+        report = ['%d clients for %.1fs' % (args.clients, elapsed)]
+        for op, name in (('read', 'ReadValue'),
+                         ('notify', 'StartNotify/StopNotify'),
+                         ('managed', 'GetManagedObjects')):
+            report.append(summarize(name, stats[op], elapsed))
+            if stats[op + ' errors']:
+                report.append('%-28s n=%d' % (name + ' errors',
+                                              len(stats[op + ' errors'])))
+        report.append('Daemon RSS idle=%dkB loaded=%dkB peak=%dkB' %
+                      (idle_rss, rss, peak_rss))
+
+        print('\n'.join(report))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        private_bus.stop()
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Logging setup of the daemon. Records are formatted only when a handler
+writes them out, so disabled or buffered records cost little more than
+the logging call itself. Hot paths log through the rate limited `hot`
+logger.
+"""
+
+import sys
+import time
+import logging
+import collections
+
+FORMAT = '[%(levelname)s] %(funcName)s: %(message)s\n'
+
+logging.basicConfig(format=FORMAT, stream=sys.stderr, level=logging.INFO)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most burst records per call site every interval
+    seconds. The number of dropped records is appended to the next record
+    let through from the same call site.
+    """
+
+    def __init__(self, interval=1.0, burst=5):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self.sites = {}
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        started, count, dropped = self.sites.get(key, (now, 0, 0))
+
+        if now - started >= self.interval:
+            if dropped:
+                record.msg = '%s [%d similar suppressed]' % (record.msg,
+                                                             dropped)
+            started, count, dropped = now, 0, 0
+
+        if count >= self.burst:
+            self.sites[key] = (started, count, dropped + 1)
+            return False
+
+        self.sites[key] = (started, count + 1, dropped)
+        return True
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keep the last capacity records in memory and hand them to target only
+    when flushed, on demand or when a record of flush_level or above
+    arrives
+    """
+
+    def __init__(self, capacity, target, flush_level=logging.ERROR):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+        self.target = target
+        self.flush_level = flush_level
+
+    def emit(self, record):
+        self.records.append(record)
+        if record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            while self.records:
+                self.target.handle(self.records.popleft())
+            self.target.flush()
+        finally:
+            self.release()
+
+
+hot = logging.getLogger('netsetup.hot')
+hot.addFilter(RateLimitFilter())
+
+ring = None
+
+
+def setup(level=logging.INFO, buffer_size=0):
+    """
+    Log to stderr at level. With a buffer_size, records are kept in a
+    ring buffer of that size and only written out on flush() or error.
+    """
+    global ring
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(FORMAT))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    if buffer_size > 0:
+        ring = RingBufferHandler(buffer_size, stream)
+        root.addHandler(ring)
+    else:
+        ring = None
+        root.addHandler(stream)
+
+    root.setLevel(level)
+
+
+def flush():
+    if ring is not None:
+        ring.flush()
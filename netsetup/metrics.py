@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import time
+import logging
+import dbus
+import dbus.service
+from dbus.service import method as dbus_method
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+STATS_BUS_NAME = 'org.knot.netsetup'
+STATS_IFACE = 'org.knot.netsetup.Stats1'
+STATS_PATH = '/org/knot/netsetup/stats'
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+
+
+class Metric(object):
+    """
+    Call and error counters plus a latency histogram of one operation
+    """
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, elapsed, error=False):
+        self.calls += 1
+        self.total += elapsed
+        if error:
+            self.errors += 1
+
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+
+
+class Measurement(object):
+    """
+    A running operation, recorded in its metric when stopped. It can be
+    used as a context manager, exceptions count as errors.
+    """
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.started = time.time()
+
+    def stop(self, error=False):
+        self.metric.observe(time.time() - self.started, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop(exc_type is not None)
+        return False
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def get(self, name, label=""):
+        key = (name, label)
+        if key not in self.metrics:
+            self.metrics[key] = Metric(name, label)
+        return self.metrics[key]
+
+    def measure(self, name, label=""):
+        return Measurement(self.get(name, label))
+
+    def reset(self):
+        self.metrics = {}
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        metrics = []
+        for (name, label), metric in sorted(self.metrics.items()):
+            labels = 'op="%s"' % name
+            if label:
+                labels += ',target="%s"' % label
+            metrics.append((labels, metric))
+
+        # Each family is described once, followed by all of its samples
+        lines = ['# HELP netsetup_calls_total Calls handled',
+                 '# TYPE netsetup_calls_total counter']
+        for labels, metric in metrics:
+            lines.append('netsetup_calls_total{%s} %d' % (labels,
+                                                          metric.calls))
+
+        lines += ['# HELP netsetup_errors_total Calls that failed',
+                  '# TYPE netsetup_errors_total counter']
+        for labels, metric in metrics:
+            lines.append('netsetup_errors_total{%s} %d' % (labels,
+                                                           metric.errors))
+
+        lines += ['# HELP netsetup_latency_seconds Time taken by the calls',
+                  '# TYPE netsetup_latency_seconds histogram']
+        for labels, metric in metrics:
+            count = 0
+            for bound, hits in zip(BUCKETS, metric.buckets):
+                count += hits
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('netsetup_latency_seconds_bucket{%s,le="%s"} %d'
+                             % (labels, le, count))
+            lines.append('netsetup_latency_seconds_sum{%s} %f' %
+                         (labels, metric.total))
+            lines.append('netsetup_latency_seconds_count{%s} %d' %
+                         (labels, metric.calls))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Atomically replace path with the current metrics, for the
+        node_exporter textfile collector
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp, path)
+
+
+registry = Registry()
+
+
+def measure(name, label=""):
+    return registry.measure(name, label)
+
+
+class StatsObject(dbus.service.Object):
+    """
+    org.knot.netsetup.Stats1 interface exposing the registry, served as
+    org.knot.netsetup. The name is allowed by the D-Bus policy installed
+    from conf/org.knot.netsetup.conf.
+    """
+
+    def __init__(self, bus, registry=registry):
+        self.registry = registry
+        try:
+            conn = dbus.service.BusName(STATS_BUS_NAME, bus,
+                                        do_not_queue=True)
+        except dbus.exceptions.DBusException as err:
+            # Still reachable by unique name, the daemon is not worth
+            # stopping for its statistics
+            logging.error('Failed to own %s: %s', STATS_BUS_NAME, err)
+            conn = bus
+        dbus.service.Object.__init__(self, conn, STATS_PATH)
+
+    @dbus_method(STATS_IFACE, out_signature='a{sa{sv}}')
+    def GetStats(self):
+        stats = {}
+        for (name, label), metric in self.registry.metrics.items():
+            key = name + (':' + label if label else '')
+            stats[key] = {
+                'Calls': dbus.UInt64(metric.calls),
+                'Errors': dbus.UInt64(metric.errors),
+                'Total': dbus.Double(metric.total),
+                'Buckets': dbus.Array(metric.buckets, signature='t'),
+                'Bounds': dbus.Array(BUCKETS, signature='d'),
+            }
+        return stats
+
+    @dbus_method(STATS_IFACE)
+    def Reset(self):
+        self.registry.reset()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Opt-in profiling of the running daemon. While enabled, calls are profiled
+with cProfile, allocations are traced with tracemalloc or, on Python 2,
+live objects are counted by type, and the mainloop dispatch latency is
+sampled. Nothing is hooked while disabled.
+"""
+
+import os
+import gc
+import sys
+import time
+import pstats
+import resource
+import logging
+import cProfile
+import collections
+import gobject as GObject
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+# Milliseconds between two mainloop latency probes
+PROBE_INTERVAL = 100
+
+# Latency samples kept, the oldest ones are dropped
+PROBE_SAMPLES = 10000
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+
+
+class LatencyProbe(object):
+    """
+    Measure how late a periodic timeout is dispatched, which is how long
+    any mainloop callback waits behind the ones running before it
+    """
+
+    def __init__(self, interval=PROBE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=PROBE_SAMPLES)
+        self.source = None
+        self.expected = None
+
+    def start(self):
+        self.expected = time.time() + self.interval / 1000.0
+        self.source = GObject.timeout_add(self.interval, self._probe_cb)
+
+    def stop(self):
+        if self.source is not None:
+            GObject.source_remove(self.source)
+            self.source = None
+
+    def _probe_cb(self):
+        now = time.time()
+        self.samples.append(max(now - self.expected, 0.0))
+        self.expected = now + self.interval / 1000.0
+        return True
+
+    def report(self):
+        if not self.samples:
+            return 'No mainloop latency samples\n'
+
+        ordered = sorted(self.samples)
+
+        def percentile(p):
+            return ordered[int(round((len(ordered) - 1) * p / 100.0))] * 1000
+
+        return ('Mainloop latency: n=%d p50=%.3fms p99=%.3fms max=%.3fms\n'
+                % (len(ordered), percentile(50), percentile(99),
+                   ordered[-1] * 1000))
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.profile = None
+        self.probe = None
+        self.started = None
+        self.object_counts = None
+
+    @property
+    def enabled(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.enabled:
+            return
+
+        logging.info('Profiling started')
+        self.started = time.time()
+        self.probe = LatencyProbe()
+        self.probe.start()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            self.object_counts = count_objects()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        self.profile.disable()
+        self.probe.stop()
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        logging.info('Profiling stopped')
+        self.profile = None
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def dump(self, directory='.'):
+        """
+        Write the profile, top allocations and mainloop latency gathered
+        so far to a report file in directory, plus the raw profile for
+        pstats based viewers. Return the report path.
+        """
+        if not self.enabled:
+            logging.info('Profiling not started, nothing to dump')
+            return None
+
+        prefix = os.path.join(directory, 'netsetup-profile-%s' %
+                              time.strftime('%Y%m%d-%H%M%S'))
+
+        self.profile.disable()
+        try:
+            self.profile.dump_stats(prefix + '.prof')
+            stream = StringIO()
+            stats = pstats.Stats(self.profile, stream=stream)
+            stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        finally:
+            self.profile.enable()
+
+        with open(prefix + '.txt', 'w') as f:
+            f.write('Profiled for %.1fs\n\n' % (time.time() - self.started))
+            f.write(self.probe.report())
+            f.write('\n')
+            f.write(self._allocations_report())
+            f.write('\n')
+            f.write(stream.getvalue())
+
+        logging.info('Profile written to %s', prefix + '.txt')
+        return prefix + '.txt'
+
+    def _allocations_report(self):
+        # ru_maxrss is in kB on Linux
+        lines = ['Max RSS: %dkB' %
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]
+
+        if tracemalloc is not None:
+            snapshot = tracemalloc.take_snapshot()
+            lines.append('Top allocations:')
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                lines.append('  ' + str(stat))
+            return '\n'.join(lines) + '\n'
+
+        # Without tracemalloc, tell where memory goes by the live objects
+        # of each type and how many more there are than when started
+        counts = count_objects()
+        lines.append('Top object counts, and growth since started:')
+        top = sorted(counts.items(), key=lambda item: -item[1])
+        for name, count in top[:TOP_ALLOCATIONS]:
+            lines.append('  %-40s %9d %+9d' % (
+                name, count, count - self.object_counts.get(name, 0)))
+        return '\n'.join(lines) + '\n'
+
+
+def count_objects():
+    """
+    Return the number of objects tracked by the garbage collector, by
+    type name
+    """
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import sys
+import logging
+
+from .wpantun import is_associated
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+# What to do once every NCP is associated
+ASSOCIATED_POLICIES = ("fast", "slow", "off")
+
+
+class AdvertisingScheduler(object):
+    """
+    Advertise fast while any NCP is not associated, so it can be found
+    quickly to be provisioned, and slow down or stop advertising once all
+    of them are associated, according to the associated policy. Intervals
+    are in milliseconds and the TX power in dBm.
+    """
+
+    def __init__(self, ble, wpans, associated="slow", fast_interval=100,
+                 slow_interval=1000, slow_tx_power=None):
+        self.ble = ble
+        self.wpans = wpans
+        self.associated = associated
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.slow_tx_power = slow_tx_power
+        self.mode = None
+
+        for wpan in self.wpans:
+            wpan.add_listener(self._wpantun_changed_cb)
+        self.update()
+
+    def _wpantun_changed_cb(self, changes):
+        if "state" in changes:
+            self.update()
+
+    def update(self):
+        associated = all(is_associated(wpan.state) for wpan in self.wpans)
+        mode = self.associated if associated else "fast"
+        if mode == self.mode:
+            return
+
+        logging.info("Advertising mode: %s", mode)
+        self.mode = mode
+
+        if mode == "off":
+            self.ble.set_advertising(False)
+        elif mode == "slow":
+            self.ble.set_advertising(True, self.slow_interval,
+                                     self.slow_tx_power)
+        else:
+            self.ble.set_advertising(True, self.fast_interval)
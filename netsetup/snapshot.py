@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import json
+import numbers
+import logging
+import gobject as GObject
+
+DEFAULT_PATH = '/var/lib/netsetup/netsetup.state'
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+
+class SnapshotStore(object):
+    """
+    Last known values of the Wpantun instances, kept in a JSON file so
+    they can be served right after a restart, before wpantund answers.
+    The file is atomically replaced a few seconds after the live values
+    change and is only readable by its owner, since it holds the
+    masterkey.
+    """
+
+    def __init__(self, path, wpans, delay=2):
+        self.path = path
+        self.wpans = wpans
+        self.delay = delay
+        self.pending = None
+        self.snapshot = {}
+
+        for wpan in self.wpans:
+            wpan.add_listener(self._wpantun_changed_cb)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError) as err:
+            logging.info('No snapshot loaded from %s: %s', self.path, err)
+            return
+
+        if not isinstance(snapshot, dict):
+            logging.info('No snapshot loaded from %s: not an object',
+                         self.path)
+            return
+        self.snapshot = snapshot
+
+        for wpan in self.wpans:
+            values = self.snapshot.get(wpan.interface)
+            if isinstance(values, dict) and values:
+                logging.info('%s: restored stale values', wpan.interface)
+                wpan.restore(values)
+
+    def _wpantun_changed_cb(self, changes):
+        if self.pending is None:
+            self.pending = GObject.timeout_add_seconds(self.delay,
+                                                       self._save_cb)
+
+    def _save_cb(self):
+        self.pending = None
+        try:
+            self.save()
+        except (IOError, OSError) as err:
+            logging.error('Failed to save snapshot: ' + str(err))
+        return False
+
+    def save(self):
+        """
+        Write the values of the Wpantun instances that are live, keeping
+        the stale ones as they were loaded
+        """
+        live = [wpan for wpan in self.wpans if not wpan.stale]
+        if not live:
+            return
+
+        for wpan in live:
+            self.snapshot[wpan.interface] = dict(
+                (attr, to_json(value))
+                for attr, value in wpan.get_values().items())
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot, f)
+        os.rename(tmp, self.path)
+
+
+def to_json(value):
+    if value is None:
+        return None
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    return u'%s' % value
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import sys
+import time
+import logging
+
+logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
+                    stream=sys.stderr, level=logging.INFO)
+
+
+class PhaseTimer(object):
+    """
+    Record when each phase of a process starts and stops, relative to the
+    creation of the timer, and log a breakdown once every started phase
+    has stopped. done_cb(total), if given, is then called with the total
+    time in seconds.
+    """
+
+    def __init__(self, name, done_cb=None):
+        self.name = name
+        self.done_cb = done_cb
+        self.origin = time.time()
+        self.phases = []
+        self.pending = {}
+        self.reported = False
+
+    def start(self, phase):
+        self.pending[phase] = time.time()
+
+    def stop(self, phase):
+        started = self.pending.pop(phase, None)
+        if started is None:
+            return
+
+        self.phases.append((phase, started - self.origin,
+                            time.time() - started))
+        if not self.pending:
+            self.report()
+
+    def get_report(self):
+        """
+        Return the finished phases as (phase, start, duration) tuples, in
+        seconds, ordered by the time they stopped
+        """
+        return list(self.phases)
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+
+        total = max(start + duration for _, start, duration in self.phases)
+        logging.info('%s took %.3fs', self.name, total)
+        for phase, start, duration in self.phases:
+            logging.info('  %-24s +%.3fs %.3fs', phase, start, duration)
+
+        if self.done_cb is not None:
+            self.done_cb(total)
@@ -5,32 +5,86 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
+import re
 import sys
+import socket
 import logging
+import numbers
+import functools
 import dbus
 import dbus.mainloop.glib
 import gobject as GObject
 
+from . import metrics
+from .timing import PhaseTimer
+
 logging.basicConfig(format='[%(levelname)s] %(funcName)s: %(message)s\n',
                     stream=sys.stderr, level=logging.INFO)
 
 INTERFACE_SERVICE_DBUS = "com.nestlabs.WPANTunnelDriver"
 INTERFACE_DBUS = "org.wpantund.v1"
-INTERFACE_DBUS_PATH = "/org/wpantund/wpan0"
+INTERFACE_DBUS_PATH = "/org/wpantund/"
+DEFAULT_INTERFACE = "wpan0"
+
+# wpantund properties cached by Wpantun, as (property, attribute) pairs
+STATUS_PROPERTIES = [
+    ("Network:NodeType", "node_type"),
+    ("Network:Name", "network_name"),
+    ("Network:PANID", "pan_id"),
+    ("NCP:Channel", "channel"),
+    ("Network:XPANID", "xpan_id"),
+    ("IPv6:MeshLocalAddress", "mesh_ipv6"),
+]
+
+PROPERTIES = dict(STATUS_PROPERTIES)
+PROPERTIES["NCP:State"] = "state"
+PROPERTIES["Network:Key"] = "masterkey"
+
+# Milliseconds during which PropertyChanged signals are merged
+COALESCE_WINDOW = 50
+
+# Seconds to wait for wpantund to answer a request
+REQUEST_TIMEOUT = 5
+
+# Seconds to wait for a Join or Form, which last until the NCP attaches
+JOIN_TIMEOUT = 60
+
+# Role the gateway takes when joining or forming a network, as the
+# node type argument of Join and Form
+NODE_TYPE_ROUTER = 2
+
+# Attributes worth restoring from a snapshot, see restore()
+CACHED_ATTRS = sorted(set(PROPERTIES.values()))
+
+# Upper bounds of the integer attributes, as encoded by the
+# characteristics and the snapshot
+INTEGER_LIMITS = {
+    "channel": 1 << 8,
+    "pan_id": 1 << 16,
+    "xpan_id": 1 << 64,
+}
+
+MASTERKEY_FORMAT = re.compile(r"^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){15}$")
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 class Singleton(type):
     """
     Singleton class to guarantee that a single instance will be used for
-    its inhereted classes
+    its inhereted classes, for each set of positional arguments
     """
     __instances = {}
 
     def __call__(cls, *args, **kwargs):
-        if cls not in cls.__instances:
-            cls.__instances[cls] = super(Singleton,
+        key = (cls,) + args
+        if key not in cls.__instances:
+            cls.__instances[key] = super(Singleton,
                                          cls).__call__(*args, **kwargs)
-        return cls.__instances[cls]
+        return cls.__instances[key]
 
 
 class Wpantun(object):
@@ -38,48 +92,456 @@ class Wpantun(object):
 
     bus = None
     iface = None
-    iface_state = None
 
     state = ""
     node_type = ""
     network_name = ""
     pan_id = 0
     channel = 0
-    xpan_id = ""
+    xpan_id = 0
     mesh_ipv6 = ""
     masterkey = ""
 
-    def __init__(self):
+    # Set while the values come from a snapshot, until wpantund answers
+    stale = False
+
+    def __init__(self, interface=DEFAULT_INTERFACE,
+                 coalesce_window=COALESCE_WINDOW,
+                 request_timeout=REQUEST_TIMEOUT):
+        self.interface = interface
+        self.path = INTERFACE_DBUS_PATH + interface
+        self.listeners = []
+        self.coalesce_window = coalesce_window
+        self.pending = {}
+        self.pending_timer = None
+        self.fetching_key = False
+        self.request_timeout = request_timeout
+        # Replies to requests of an older generation are dropped
+        self.generation = 0
+        self.refreshing = False
+        self.refresh_queued = False
+        self.refresh_callbacks = []
+        self.timer = None
+        self.owner = None
+        self.recovery = None
         self.bus = dbus.SystemBus()
+        # Following the name owner keeps the proxy, and the signal
+        # subscription, working across wpantund restarts
         self.iface = self.bus.get_object(
             INTERFACE_SERVICE_DBUS,
-            INTERFACE_DBUS_PATH)
-
-        self.iface_state = self.bus.get_object(
-            INTERFACE_SERVICE_DBUS,
-            "/com/nestlabs/WPANTunnelDriver/wpan0/Properties/NCP/State")
+            self.path,
+            introspect=False,
+            follow_name_owner_changes=True)
 
-        self.refresh_values()
         self._register_signals_listener()
+        self.bus.watch_name_owner(INTERFACE_SERVICE_DBUS,
+                                  self._name_owner_changed_cb)
+
+    def start(self, timer=None):
+        """
+        Fill the cache without blocking, the values are announced to the
+        listeners as the replies arrive
+        """
+        self.timer = timer
+        if self.timer is not None:
+            self.timer.start("wpantund status " + self.interface)
+        self.refresh_values(self._started_cb)
+
+    def _started_cb(self):
+        if self.timer is not None:
+            self.timer.stop("wpantund status " + self.interface)
+
+    def _name_owner_changed_cb(self, owner):
+        previous = self.owner
+        self.owner = owner
+        if previous is None or bool(previous) == bool(owner):
+            return
+
+        if not owner:
+            logging.info("%s: wpantund left the bus", self.interface)
+            self.recovery = PhaseTimer("wpantund recovery " + self.interface,
+                                       self._recovered_cb)
+            self.recovery.start("wpantund restart")
+            self.cancel_requests()
+            # Keep serving the cached values, but flag them as unverified
+            self._update("stale", True)
+            return
+
+        logging.info("%s: wpantund is back", self.interface)
+        if self.recovery is not None:
+            self.recovery.start("wpantund status")
+            self.recovery.stop("wpantund restart")
+        self.refresh_values(self._refreshed_cb)
+
+    def _refreshed_cb(self):
+        if self.recovery is not None:
+            self.recovery.stop("wpantund status")
+            self.recovery = None
+
+    def _recovered_cb(self, total):
+        metrics.registry.get("recovery", "wpantund").observe(total)
 
     def _register_signals_listener(self):
-        self.iface_state.connect_to_signal(
-            "PropertyChanged", self.refresh_values())
+        self.bus.add_signal_receiver(
+            self._property_changed_cb,
+            signal_name="PropertyChanged",
+            dbus_interface=INTERFACE_DBUS,
+            bus_name=INTERFACE_SERVICE_DBUS,
+            path=self.path)
+
+    def _property_changed_cb(self, key, value):
+        attr = PROPERTIES.get(key)
+        if attr is None:
+            return
+
+        if key == "Network:Key":
+            value = format_key(value)
+
+        # Storms of signals, e.g. while joining, are applied as one batch
+        self.pending[attr] = value
+        if self.fetching_key:
+            # Applied along with the key once it is fetched
+            return
+        if self.coalesce_window <= 0:
+            self._flush_cb()
+        elif self.pending_timer is None:
+            self.pending_timer = GObject.timeout_add(self.coalesce_window,
+                                                     self._flush_cb)
+
+    def _flush_cb(self):
+        self.pending_timer = None
+        state = self.pending.get("state", self.state)
+        if state != self.state and is_associated(state):
+            # The key is not part of Status() and is not always
+            # announced when the node (re)joins the network. The batch
+            # is held until it is fetched, so both are announced at once.
+            self._fetch_masterkey()
+        else:
+            self._apply_pending()
+        return False
+
+    def _apply_pending(self):
+        changes = self.pending
+        self.pending = {}
+        self._apply(changes)
+
+    def _apply(self, changes):
+        """
+        Store the new values and announce the ones that actually changed
+        to the listeners, all at once. Return the changed values.
+        """
+        changed = dict((attr, value) for attr, value in changes.items()
+                       if getattr(self, attr) != value)
+        if not changed:
+            return changed
+
+        for attr, value in changed.items():
+            setattr(self, attr, value)
+        logging.info("%s: %s changed", self.interface,
+                     ", ".join(sorted(changed)))
+
+        for listener in self.listeners:
+            listener(changed)
+
+        return changed
+
+    def _update(self, attr, value):
+        return bool(self._apply({attr: value}))
+
+    def _fetch_masterkey(self):
+        self.fetching_key = True
+        self.iface.PropGet(
+            "Network:Key", dbus_interface=INTERFACE_DBUS,
+            timeout=self.request_timeout,
+            reply_handler=functools.partial(self._masterkey_reply_cb,
+                                            self.generation),
+            error_handler=functools.partial(self._masterkey_error_cb,
+                                            self.generation))
+
+    def _masterkey_reply_cb(self, generation, result, mkey):
+        if generation != self.generation:
+            return
+
+        self.fetching_key = False
+        if result == 0 and is_associated(self.pending.get("state",
+                                                          self.state)):
+            self.pending["masterkey"] = format_key(mkey)
+        self._apply_pending()
+
+    def _masterkey_error_cb(self, generation, error):
+        if generation != self.generation:
+            return
+
+        self._error_cb(error)
+        self.fetching_key = False
+        self._apply_pending()
+
+    def _error_cb(self, error):
+        logging.error("%s: wpantund request failed: %s", self.interface,
+                      error)
+
+    def add_listener(self, callback):
+        """
+        Register a callback(changes) called whenever cached properties
+        change, with a dictionary of their new values by attribute
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def cancel_requests(self):
+        """
+        Drop the replies of the requests in flight, e.g. when wpantund
+        left the bus. Pending refresh_values() callbacks are kept and
+        called once the next refresh completes.
+        """
+        self.generation += 1
+        self.refreshing = False
+        self.refresh_queued = False
+        if self.fetching_key:
+            # Announce the batch held for the key without it
+            self.fetching_key = False
+            self._apply_pending()
+
+    def refresh_values(self, done_cb=None):
+        """
+        Fetch the whole status from wpantund. Only needed at startup,
+        afterwards the cache is kept up to date by PropertyChanged signals.
+
+        Status() and the network key are requested in parallel, without
+        blocking, and done_cb is called once both have answered or timed
+        out. At most one refresh is in flight: a refresh requested
+        meanwhile is started once the current one completes.
+        """
+        if done_cb is not None:
+            self.refresh_callbacks.append(done_cb)
+
+        if self.refreshing:
+            self.refresh_queued = True
+            return
+
+        self.refreshing = True
+        generation = self.generation
+        replies = {}
+        measurement = metrics.measure("refresh_values", self.interface)
+
+        def reply_cb(name, *args):
+            if generation != self.generation:
+                return
+
+            replies[name] = args
+            if len(replies) < 2:
+                return
+
+            measurement.stop(not replies["status"] or not replies["key"])
+            self.refreshing = False
+            self._apply_status(replies["status"], replies["key"])
+
+            if self.refresh_queued:
+                self.refresh_queued = False
+                self.refresh_values()
+                return
+
+            callbacks = self.refresh_callbacks
+            self.refresh_callbacks = []
+            for callback in callbacks:
+                callback()
+
+        def error_cb(name, error):
+            if generation == self.generation:
+                self._error_cb(error)
+            reply_cb(name)
+
+        self.iface.Status(
+            dbus_interface=INTERFACE_DBUS,
+            timeout=self.request_timeout,
+            reply_handler=functools.partial(reply_cb, "status"),
+            error_handler=functools.partial(error_cb, "status"))
+
+        self.iface.PropGet(
+            "Network:Key", dbus_interface=INTERFACE_DBUS,
+            timeout=self.request_timeout,
+            reply_handler=functools.partial(reply_cb, "key"),
+            error_handler=functools.partial(error_cb, "key"))
+
+    def _apply_status(self, status_reply, key_reply):
+        if not status_reply:
+            return
+
+        status = status_reply[0]
+        changes = {"state": status.get("NCP:State"), "stale": False}
+
+        if is_associated(changes["state"]):
+            for key, attr in STATUS_PROPERTIES:
+                changes[attr] = status.get(key)
+
+            if key_reply:
+                changes["masterkey"] = format_key(key_reply[1])
+
+        self._apply(changes)
+
+    def restore(self, values):
+        """
+        Load the last known values, e.g. from a snapshot taken before a
+        reboot, and mark them as stale until wpantund answers
+        """
+        changes = {}
+        for attr in CACHED_ATTRS:
+            if attr not in values:
+                continue
+            if not is_valid_value(attr, values[attr]):
+                logging.error("%s: ignoring restored %s %r", self.interface,
+                              attr, values[attr])
+                continue
+            changes[attr] = values[attr]
+
+        changes["stale"] = True
+        self._apply(changes)
+
+    def get_values(self):
+        return dict((attr, getattr(self, attr)) for attr in CACHED_ATTRS)
+
+    def configure(self, settings, form=False, reply_cb=None, error_cb=None):
+        """
+        Apply settings, a dictionary of network_name, channel, pan_id,
+        xpan_id and masterkey values, as a single join or form. Settings
+        left out keep their current value.
+
+        The network key, and on form the PAN and extended PAN IDs which
+        Form does not take, are set first with PropSet. The cache is then
+        updated by the PropertyChanged signals as usual.
+        """
+        values = self.get_values()
+        values.update(settings)
+
+        steps = []
+        if "masterkey" in settings:
+            steps.append(("PropSet", "sv",
+                          ("Network:Key", parse_key(values["masterkey"]))))
+        if form:
+            if "pan_id" in settings:
+                steps.append(("PropSet", "sv",
+                              ("Network:PANID",
+                               dbus.UInt16(values["pan_id"]))))
+            if "xpan_id" in settings:
+                steps.append(("PropSet", "sv",
+                              ("Network:XPANID",
+                               dbus.UInt64(values["xpan_id"]))))
+            steps.append(("Form", "snu", (values["network_name"],
+                                          NODE_TYPE_ROUTER,
+                                          1 << values["channel"])))
+        else:
+            steps.append(("Join", "sntqu", (values["network_name"],
+                                            NODE_TYPE_ROUTER,
+                                            values["xpan_id"],
+                                            values["pan_id"],
+                                            values["channel"])))
+
+        measurement = metrics.measure("form" if form else "join",
+                                      self.interface)
+
+        def step_error_cb(error):
+            measurement.stop(True)
+            if error_cb is not None:
+                error_cb(error)
+
+        def next_step_cb(*args):
+            if not steps:
+                measurement.stop()
+                logging.info("%s: %s done", self.interface,
+                             "form" if form else "join")
+                if reply_cb is not None:
+                    reply_cb()
+                return
+
+            method, signature, step_args = steps.pop(0)
+            self._call(method, signature, step_args, next_step_cb,
+                       step_error_cb,
+                       None if method == "PropSet" else JOIN_TIMEOUT)
+
+        next_step_cb()
+
+    def start_commissioner(self, reply_cb=None, error_cb=None):
+        self._call("PropSet", "sv", ("Commissioner:State", "active"),
+                   reply_cb, error_cb)
+
+    def add_joiner(self, eui64, pskd, timeout, reply_cb=None, error_cb=None):
+        """
+        Allow the joiner eui64, 8 bytes, to join with pskd for the next
+        timeout seconds
+        """
+        self._call("JoinerAdd", "suay",
+                   (pskd, timeout, dbus.ByteArray(bytes(eui64))),
+                   reply_cb, error_cb)
+
+    def _call(self, method, signature, args, reply_cb=None, error_cb=None,
+              timeout=None):
+        """
+        Call a wpantund method answering with a status, without blocking.
+        A non zero status is handed to error_cb like a D-Bus error.
+        """
+        def status_cb(status, *values):
+            if status:
+                error = dbus.exceptions.DBusException(
+                    "%s failed with status %d" % (method, status))
+                call_error_cb(error)
+            elif reply_cb is not None:
+                reply_cb()
+
+        def call_error_cb(error):
+            self._error_cb(error)
+            if error_cb is not None:
+                error_cb(error)
+
+        getattr(self.iface, method)(
+            *args, signature=signature,
+            dbus_interface=INTERFACE_DBUS,
+            timeout=timeout or self.request_timeout,
+            reply_handler=status_cb,
+            error_handler=call_error_cb)
+
+
+def is_associated(state):
+    """
+    Return whether the NCP state is one of the associated ones, such as
+    associated:no-parent, the same way wpantund tells
+    """
+    return (state or "").split(":")[0] == "associated"
+
+
+def is_valid_value(attr, value):
+    """
+    Return whether value, e.g. read back from a snapshot, has the type
+    and range of the Wpantun attribute attr
+    """
+    if value is None:
+        return True
+
+    if attr in INTEGER_LIMITS:
+        return isinstance(value, numbers.Integral) and \
+            not isinstance(value, bool) and \
+            0 <= value < INTEGER_LIMITS[attr]
+
+    if not isinstance(value, string_types):
+        return False
+
+    if attr == "masterkey":
+        return not value or MASTERKEY_FORMAT.match(value) is not None
+
+    if attr == "mesh_ipv6" and value:
+        try:
+            socket.inet_pton(socket.AF_INET6, str(value))
+        except (socket.error, ValueError, UnicodeError):
+            return False
 
-    def refresh_values(self):
-        status = self.iface.Status(dbus_interface=INTERFACE_DBUS)
+    return True
 
-        self.state = status.get("NCP:State")
 
-        if self.state == "associated":
-            self.node_type = status.get("Network:NodeType")
-            self.network_name = status.get("Network:Name")
-            self.pan_id = status.get("Network:PANID")
-            self.channel = status.get("NCP:Channel")
-            self.xpan_id = status.get("Network:XPANID")
-            self.mesh_ipv6 = status.get("IPv6:MeshLocalAddress")
+def format_key(key):
+    return ":".join(['%02x' % item for item in key])
 
-            mkey = self.iface.PropGet(
-                "Network:Key", dbus_interface=INTERFACE_DBUS)[1]
 
-            self.masterkey = ":".join(['%02x' % item for item in mkey])
+def parse_key(key):
+    return dbus.ByteArray(bytes(bytearray(int(item, 16)
+                                          for item in key.split(":"))))
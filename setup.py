@@ -22,9 +22,13 @@ setup(
     url="https://github.com/CESARBR/knot-gateway-netsetup",
     packages=find_packages(),
     long_description=read("README.md"),
+    data_files=[
+        ("/etc/dbus-1/system.d", ["conf/org.knot.netsetup.conf"]),
+    ],
     entry_points={
         "console_scripts": [
-            "netsetup = netsetup.__main__:main"
+            "netsetup = netsetup.__main__:main",
+            "netsetup-loadgen = netsetup.loadgen:main"
         ]
     },
     classifiers=[
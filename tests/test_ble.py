@@ -0,0 +1,288 @@
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Wire formats of the GATT characteristics. Run with:
+python -m unittest discover -s tests
+"""
+
+import unittest
+
+try:
+    from netsetup import ble
+except ImportError:
+    # dbus-python and gobject are needed to import the daemon
+    ble = None
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class SliceValueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.value = ble.encode_value(ble.encode_string, u"0123456789")
+
+    def test_whole_value_is_the_cached_buffer(self):
+        self.assertIs(ble.slice_value(self.value, {}), self.value)
+        self.assertIs(ble.slice_value(self.value, {'mtu': 23}), self.value)
+
+    def test_mtu_limits_the_length(self):
+        self.assertEqual(bytes(ble.slice_value(self.value, {'mtu': 5})),
+                         b"0123")
+
+    def test_long_read_continues_at_offset(self):
+        options = {'offset': 4, 'mtu': 5}
+        self.assertEqual(bytes(ble.slice_value(self.value, options)),
+                         b"4567")
+        options = {'offset': 8, 'mtu': 5}
+        self.assertEqual(bytes(ble.slice_value(self.value, options)), b"89")
+
+    def test_offset_at_the_end_is_empty(self):
+        options = {'offset': len(self.value)}
+        self.assertEqual(bytes(ble.slice_value(self.value, options)), b"")
+
+    def test_offset_past_the_end_is_rejected(self):
+        options = {'offset': len(self.value) + 1}
+        self.assertRaises(ble.InvalidOffsetException, ble.slice_value,
+                          self.value, options)
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class EncodeSnapshotTest(unittest.TestCase):
+    MASTERKEY = ":".join("%02x" % i for i in range(16))
+
+    def test_tlv_layout(self):
+        values = (15, u"KNoT", 0x1234, 0xdead00beef00cafe, self.MASTERKEY,
+                  u"associated", u"fd00::1", False)
+        expected = (b"\x01" +
+                    b"\x01\x01\x0f" +
+                    b"\x02\x04KNoT" +
+                    b"\x03\x02\x12\x34" +
+                    b"\x04\x08\xde\xad\x00\xbe\xef\x00\xca\xfe" +
+                    b"\x05\x10" + bytes(bytearray(range(16))) +
+                    b"\x06\x0aassociated" +
+                    b"\x07\x10\xfd" + b"\x00" * 14 + b"\x01" +
+                    b"\x08\x01\x00")
+        self.assertEqual(ble.encode_snapshot(values), expected)
+
+    def test_unknown_fields_are_left_out(self):
+        values = (None, u"KNoT", None, None, None, None, None, True)
+        self.assertEqual(ble.encode_snapshot(values),
+                         b"\x01\x02\x04KNoT\x08\x01\x01")
+
+    def test_version_only_when_empty(self):
+        values = (None,) * len(ble.SNAPSHOT_ATTRS)
+        self.assertEqual(ble.encode_snapshot(values), b"\x01")
+
+
+class FakeWpantun(object):
+    state = None
+    channel = None
+    pan_id = None
+    xpan_id = None
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class EncodeAdStatusTest(unittest.TestCase):
+
+    def state_code(self, state):
+        wpan = FakeWpantun()
+        wpan.state = state
+        return ble.encode_ad_status(wpan)[0]
+
+    def test_full_states(self):
+        self.assertEqual(self.state_code(u"associated"), 5)
+        self.assertEqual(self.state_code(u"associated:no-parent"), 6)
+        self.assertEqual(self.state_code(u"associated:netwake-asleep"), 7)
+        self.assertEqual(self.state_code(u"offline:commissioned"), 2)
+        self.assertEqual(
+            self.state_code(u"associating:credentials-needed"), 4)
+
+    def test_unknown_states(self):
+        self.assertEqual(self.state_code(None), 0xff)
+        self.assertEqual(self.state_code(u"associated:unknown"), 0xff)
+
+    def test_layout(self):
+        wpan = FakeWpantun()
+        wpan.state = u"offline"
+        wpan.channel = 15
+        self.assertEqual(len(ble.encode_ad_status(wpan)), 4)
+        self.assertEqual(ble.encode_ad_status(wpan)[:2], bytearray([1, 15]))
+
+
+class FakeNetwork(object):
+    """
+    Wpantun as seen by KnotService.commit()
+    """
+    state = u"offline"
+
+    def __init__(self):
+        self.configured = []
+
+    def get_values(self):
+        return {}
+
+    def configure(self, settings, form, reply_cb, error_cb):
+        self.configured.append((settings, form))
+
+
+class FakeCache(object):
+
+    def __init__(self, wpan):
+        self.wpan = wpan
+
+
+class FakeCommitCharacteristic(object):
+    result = None
+
+    def set_result(self, result):
+        self.result = result
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class CommitTest(unittest.TestCase):
+    DEVICE = "/org/bluez/hci0/dev_00_11_22_33_44_55"
+    OTHER = "/org/bluez/hci0/dev_66_77_88_99_AA_BB"
+
+    def setUp(self):
+        # Skip the bus, commit() only needs the cache and its results
+        self.wpan = FakeNetwork()
+        self.service = object.__new__(ble.KnotService)
+        self.service.path = "/org/bluez/knot/service0"
+        self.service.cache = FakeCache(self.wpan)
+        self.service.staged = {}
+        self.service.stage_timers = {}
+        self.service.commit_chrc = FakeCommitCharacteristic()
+
+    def tearDown(self):
+        for device in list(self.service.stage_timers):
+            self.service.drop_timer(device)
+
+    def stage(self, device, **values):
+        for attr, value in values.items():
+            self.service.stage(attr, value, device)
+
+    def test_join_needs_pan_ids(self):
+        self.stage(self.DEVICE, network_name=u"KNoT", channel=15)
+        self.assertRaises(ble.InvalidArgsException, self.service.commit,
+                          ble.COMMIT_JOIN, self.DEVICE)
+        self.stage(self.DEVICE, pan_id=0x1234)
+        self.assertRaises(ble.InvalidArgsException, self.service.commit,
+                          ble.COMMIT_JOIN, self.DEVICE)
+        self.assertEqual(self.wpan.configured, [])
+
+        self.stage(self.DEVICE, xpan_id=0xdead00beef00cafe)
+        self.service.commit(ble.COMMIT_JOIN, self.DEVICE)
+        self.assertEqual(self.wpan.configured, [
+            ({"network_name": u"KNoT", "channel": 15, "pan_id": 0x1234,
+              "xpan_id": 0xdead00beef00cafe}, False)])
+        self.assertEqual(self.service.commit_chrc.result, ble.COMMIT_PENDING)
+        self.assertNotIn(self.DEVICE, self.service.staged)
+
+    def test_form_picks_pan_ids(self):
+        self.stage(self.DEVICE, network_name=u"KNoT", channel=26)
+        self.service.commit(ble.COMMIT_FORM, self.DEVICE)
+        self.assertEqual(self.wpan.configured,
+                         [({"network_name": u"KNoT", "channel": 26}, True)])
+
+    def test_channel_out_of_range(self):
+        for channel in (10, 27, 0):
+            self.stage(self.DEVICE, network_name=u"KNoT", channel=channel)
+            self.assertRaises(ble.InvalidArgsException, self.service.commit,
+                              ble.COMMIT_FORM, self.DEVICE)
+        self.assertEqual(self.wpan.configured, [])
+
+    def test_abort_drops_only_that_device(self):
+        self.stage(self.DEVICE, network_name=u"KNoT", channel=15)
+        self.stage(self.OTHER, network_name=u"Other", channel=20)
+        self.service.commit(ble.COMMIT_ABORT, self.DEVICE)
+        self.assertNotIn(self.DEVICE, self.service.staged)
+        self.assertNotIn(self.DEVICE, self.service.stage_timers)
+
+        self.assertRaises(ble.InvalidArgsException, self.service.commit,
+                          ble.COMMIT_FORM, self.DEVICE)
+        self.service.commit(ble.COMMIT_FORM, self.OTHER)
+        self.assertEqual(self.wpan.configured,
+                         [({"network_name": u"Other", "channel": 20}, True)])
+
+    def test_devices_do_not_share_values(self):
+        self.stage(self.DEVICE, network_name=u"KNoT")
+        self.stage(self.OTHER, channel=15)
+        self.assertRaises(ble.InvalidArgsException, self.service.commit,
+                          ble.COMMIT_FORM, self.OTHER)
+
+    def test_disconnect_drops_staged_values(self):
+        self.stage(self.DEVICE, network_name=u"KNoT", channel=15)
+        self.service._device_changed_cb(ble.DEVICE_IFACE,
+                                        {"Connected": False}, [],
+                                        path=self.DEVICE)
+        self.assertNotIn(self.DEVICE, self.service.staged)
+        self.assertNotIn(self.DEVICE, self.service.stage_timers)
+
+    def test_bad_opcode(self):
+        self.assertRaises(ble.InvalidArgsException, self.service.commit, 3,
+                          self.DEVICE)
+
+
+def joiner_entry(eui64, pskd):
+    return bytearray(eui64) + bytearray([len(pskd)]) + bytearray(pskd)
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class ParseJoinersTest(unittest.TestCase):
+    EUI64 = b"\x00\x11\x22\x33\x44\x55\x66\x77"
+
+    def test_entries(self):
+        data = (joiner_entry(self.EUI64, b"ABC123") +
+                joiner_entry(b"\xff" * 8, b"J01NME" * 5))
+        joiners, used = ble.parse_joiners(data)
+        self.assertEqual(joiners, [(bytearray(self.EUI64), u"ABC123"),
+                                   (bytearray(b"\xff" * 8), u"J01NME" * 5)])
+        self.assertEqual(used, len(data))
+
+    def test_partial_entries_are_left_out(self):
+        entry = joiner_entry(self.EUI64, b"ABC123")
+        for cut in (1, 8, 9, len(entry) - 1):
+            joiners, used = ble.parse_joiners(entry + entry[:cut])
+            self.assertEqual(len(joiners), 1)
+            self.assertEqual(used, len(entry))
+
+    def test_entry_straddling_two_writes(self):
+        entry = joiner_entry(self.EUI64, b"ABC123")
+        first = entry + entry[:12]
+        joiners, used = ble.parse_joiners(first)
+        self.assertEqual(len(joiners), 1)
+
+        joiners, used = ble.parse_joiners(first[used:] + entry[12:])
+        self.assertEqual(joiners, [(bytearray(self.EUI64), u"ABC123")])
+        self.assertEqual(used, len(entry))
+
+    def test_bad_pskd_characters(self):
+        for pskd in (b"ABC12I", b"ABC12O", b"ABC12Q", b"ABC12Z", b"abc123",
+                     b"ABC 12"):
+            self.assertRaises(ble.InvalidArgsException, ble.parse_joiners,
+                              joiner_entry(self.EUI64, pskd))
+
+    def test_bad_pskd_lengths(self):
+        for pskd in (b"", b"ABC12", b"A" * 33):
+            self.assertRaises(ble.InvalidArgsException, ble.parse_joiners,
+                              joiner_entry(self.EUI64, pskd))
+        for pskd in (b"A" * 6, b"A" * 32):
+            joiners, used = ble.parse_joiners(joiner_entry(self.EUI64, pskd))
+            self.assertEqual(len(joiners), 1)
+
+
+@unittest.skipIf(ble is None, "dbus-python and gobject are not available")
+class JoinerStatusTest(unittest.TestCase):
+
+    def test_layout(self):
+        value = ble.JOINER_STATUS.pack(1, 2, 0x0304, 5, b"\x00" * 7 + b"\x01",
+                                       3)
+        self.assertEqual(value, b"\x00\x01\x00\x02\x03\x04\x00\x05" +
+                         b"\x00" * 7 + b"\x01\x03")
+        self.assertEqual(ble.JOINER_STATUS.size, 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Prometheus export of the metrics. Run with:
+python -m unittest discover -s tests
+"""
+
+import unittest
+
+try:
+    from netsetup import metrics
+except ImportError:
+    # dbus-python is needed to import the daemon
+    metrics = None
+
+
+@unittest.skipIf(metrics is None, "dbus-python is not available")
+class ToPrometheusTest(unittest.TestCase):
+    FAMILIES = (("netsetup_calls_total", "counter"),
+                ("netsetup_errors_total", "counter"),
+                ("netsetup_latency_seconds", "histogram"))
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.registry.get("ReadValue", "/char0").observe(0.002)
+        self.registry.get("ReadValue", "/char1").observe(0.3, error=True)
+        self.registry.get("GetManagedObjects").observe(0.0001)
+        self.lines = self.registry.to_prometheus().splitlines()
+
+    def test_families_are_described_once(self):
+        for family, kind in self.FAMILIES:
+            self.assertEqual(self.lines.count("# TYPE %s %s" %
+                                              (family, kind)), 1)
+            self.assertEqual(len([line for line in self.lines
+                                  if line.startswith("# HELP %s " %
+                                                     family)]), 1)
+
+    def test_samples_follow_their_family(self):
+        family = None
+        for line in self.lines:
+            if line.startswith("# TYPE "):
+                family = line.split()[2]
+            elif not line.startswith("#"):
+                self.assertTrue(line.startswith(family), line)
+
+    def test_values(self):
+        self.assertIn('netsetup_calls_total{op="ReadValue",target="/char1"}'
+                      ' 1', self.lines)
+        self.assertIn('netsetup_errors_total{op="ReadValue",'
+                      'target="/char1"} 1', self.lines)
+        self.assertIn('netsetup_latency_seconds_bucket{op="ReadValue",'
+                      'target="/char0",le="+Inf"} 1', self.lines)
+        self.assertIn('netsetup_latency_seconds_count'
+                      '{op="GetManagedObjects"} 1', self.lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
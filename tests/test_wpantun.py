@@ -0,0 +1,164 @@
+#
+# Copyright (c) 2019, CESAR. All rights reserved.
+#
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+Values restored from a snapshot. Run with:
+python -m unittest discover -s tests
+"""
+
+import unittest
+
+try:
+    from netsetup import wpantun
+except ImportError:
+    # dbus-python and gobject are needed to import the daemon
+    wpantun = None
+
+
+@unittest.skipIf(wpantun is None, "dbus-python and gobject are not available")
+class IsValidValueTest(unittest.TestCase):
+    MASTERKEY = ":".join("%02x" % i for i in range(16))
+
+    def test_good_values(self):
+        for attr, value in (("channel", 15), ("pan_id", 0xffff),
+                            ("xpan_id", 0xdead00beef00cafe),
+                            ("network_name", u"KNoT"),
+                            ("state", u"associated"),
+                            ("masterkey", self.MASTERKEY),
+                            ("masterkey", u""),
+                            ("mesh_ipv6", u"fd00::1"),
+                            ("mesh_ipv6", u""), ("channel", None)):
+            self.assertTrue(wpantun.is_valid_value(attr, value),
+                            (attr, value))
+
+    def test_wrong_types(self):
+        for attr, value in (("channel", u"11"), ("channel", True),
+                            ("channel", 11.0), ("pan_id", [1]),
+                            ("network_name", 42), ("masterkey", 0),
+                            ("mesh_ipv6", {})):
+            self.assertFalse(wpantun.is_valid_value(attr, value),
+                             (attr, value))
+
+    def test_out_of_range(self):
+        for attr, value in (("channel", 256), ("channel", -1),
+                            ("pan_id", 0x10000), ("xpan_id", 1 << 64)):
+            self.assertFalse(wpantun.is_valid_value(attr, value),
+                             (attr, value))
+
+    def test_bad_masterkey_and_address(self):
+        for attr, value in (("masterkey", u"00:11"),
+                            ("masterkey", self.MASTERKEY + u":00"),
+                            ("masterkey", u"zz" + self.MASTERKEY[2:]),
+                            ("mesh_ipv6", u"fd00::1::2"),
+                            ("mesh_ipv6", u"192.168.0.1")):
+            self.assertFalse(wpantun.is_valid_value(attr, value),
+                             (attr, value))
+
+
+@unittest.skipIf(wpantun is None, "dbus-python and gobject are not available")
+class IsAssociatedTest(unittest.TestCase):
+
+    def test_associated_states(self):
+        for state in (u"associated", u"associated:no-parent",
+                      u"associated:netwake-asleep",
+                      u"associated:netwake-waking"):
+            self.assertTrue(wpantun.is_associated(state), state)
+
+    def test_other_states(self):
+        for state in (None, u"", u"offline", u"offline:commissioned",
+                      u"associating", u"associating:credentials-needed",
+                      u"uninitialized:fault"):
+            self.assertFalse(wpantun.is_associated(state), state)
+
+
+@unittest.skipIf(wpantun is None, "dbus-python and gobject are not available")
+class RestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        # Skip the Singleton and the bus, restore() only needs listeners
+        self.wpan = object.__new__(wpantun.Wpantun)
+        self.wpan.interface = "wpan0"
+        self.wpan.listeners = []
+
+    def test_bad_entries_are_dropped(self):
+        changes = []
+        self.wpan.add_listener(changes.append)
+        self.wpan.restore({"channel": u"11", "network_name": u"KNoT",
+                           "masterkey": u"nope", "pan_id": 0x1234})
+
+        self.assertEqual(changes, [{"network_name": u"KNoT",
+                                    "pan_id": 0x1234, "stale": True}])
+        self.assertEqual(self.wpan.channel, 0)
+        self.assertEqual(self.wpan.masterkey, "")
+
+
+
+class FakeInterface(object):
+    """
+    wpantund proxy keeping the PropGet calls for the test to answer
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def PropGet(self, key, **kwargs):
+        self.calls.append((key, kwargs))
+
+
+@unittest.skipIf(wpantun is None, "dbus-python and gobject are not available")
+class FlushTest(unittest.TestCase):
+    KEY = bytearray(range(16))
+
+    def setUp(self):
+        # Skip the Singleton and the bus, signals are fed by hand
+        self.wpan = object.__new__(wpantun.Wpantun)
+        self.wpan.interface = "wpan0"
+        self.wpan.listeners = []
+        self.wpan.coalesce_window = 0
+        self.wpan.pending = {}
+        self.wpan.pending_timer = None
+        self.wpan.fetching_key = False
+        self.wpan.request_timeout = wpantun.REQUEST_TIMEOUT
+        self.wpan.generation = 0
+        self.wpan.iface = FakeInterface()
+        self.changes = []
+        self.wpan.add_listener(self.changes.append)
+
+    def test_key_is_announced_with_the_state(self):
+        self.wpan._property_changed_cb("NCP:State", u"associated")
+        self.wpan._property_changed_cb("Network:Name", u"KNoT")
+        self.assertEqual(self.changes, [])
+        self.assertEqual([key for key, kwargs in self.wpan.iface.calls],
+                         ["Network:Key"])
+
+        self.wpan.iface.calls[0][1]["reply_handler"](0, self.KEY)
+        self.assertEqual(self.changes, [{
+            "state": u"associated", "network_name": u"KNoT",
+            "masterkey": wpantun.format_key(self.KEY)}])
+
+    def test_key_error_announces_the_batch(self):
+        self.wpan._property_changed_cb("NCP:State", u"associated")
+        self.wpan.iface.calls[0][1]["error_handler"](Exception("timeout"))
+        self.assertEqual(self.changes, [{"state": u"associated"}])
+        self.assertFalse(self.wpan.fetching_key)
+
+    def test_cancelled_fetch_announces_the_batch(self):
+        self.wpan.refreshing = False
+        self.wpan.refresh_queued = False
+        self.wpan._property_changed_cb("NCP:State", u"associated")
+        self.wpan.cancel_requests()
+        self.assertEqual(self.changes, [{"state": u"associated"}])
+
+        self.wpan.iface.calls[0][1]["reply_handler"](0, self.KEY)
+        self.assertEqual(len(self.changes), 1)
+
+    def test_other_states_are_not_held(self):
+        self.wpan._property_changed_cb("NCP:State", u"offline")
+        self.assertEqual(self.changes, [{"state": u"offline"}])
+        self.assertEqual(self.wpan.iface.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()